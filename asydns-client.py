@@ -1,6 +1,10 @@
 import base64
 import json
+import random
+import socket
 from pathlib import Path
+from time import sleep, strftime, time
+from urllib.parse import urlparse
 
 import click
 import requests
@@ -10,40 +14,213 @@ from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 
 
+def generate_key(key_type):
+    """Returns a new private key of key_type, as PEM"""
+
+    if key_type == 'rsa':
+        random_generator = Random.new().read
+        return RSA.generate(2048, random_generator).exportKey('PEM').decode()
+
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+    if key_type == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        key = ec.generate_private_key(ec.SECP256R1())
+
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def load_key(key_type, pem):
+    """Returns (public key PEM, sign function) for a private key PEM"""
+
+    if key_type == 'rsa':
+        key = RSA.importKey(pem)
+        signer = PKCS1_v1_5.new(key)
+        return key.publickey().exportKey('PEM').decode(), lambda challenge: signer.sign(SHA224.new(challenge))
+
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = serialization.load_pem_private_key(pem.encode(), password=None)
+    pub = key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+    if key_type == 'ed25519':
+        return pub, lambda challenge: key.sign(challenge)
+
+    return pub, lambda challenge: key.sign(challenge, ec.ECDSA(hashes.SHA256()))
+
+
+class APIError(Exception):
+
+    def __init__(self, response):
+        """A response of the API other than 200 (retry_after from its Retry-After, if any)"""
+
+        super().__init__('{} {}'.format(response.status_code, response.content.decode(errors='replace')))
+
+        try:
+            self.retry_after = int(response.headers.get('Retry-After', 0))
+        except ValueError:
+            self.retry_after = 0
+
+
+class Revoked(Exception):
+    pass
+
+
+def log(message):
+
+    print('{} {}'.format(strftime('%Y-%m-%d %H:%M:%S'), message), flush=True)
+
+
+def local_address(url):
+    """Address of the local interface used to reach the API
+
+    Connecting a UDP socket only picks the route, no packet is sent, so this can run
+    often to notice a new address (another network, a new DHCP lease) at once.
+    """
+
+    url = urlparse(url)
+    port = url.port or (443 if url.scheme == 'https' else 80)
+
+    family, type, proto, name, sockaddr = socket.getaddrinfo(url.hostname, port, type=socket.SOCK_DGRAM)[0]
+
+    with socket.socket(family, socket.SOCK_DGRAM) as s:
+        s.connect(sockaddr)
+        return s.getsockname()[0]
+
+
+def get_challenge(session, url):
+    """GET /api: the challenge, and the address the server sees (None on older servers)"""
+
+    r = session.get(url + '/api', timeout=30)
+
+    if r.status_code != 200:
+        raise APIError(r)
+
+    j = r.json()
+
+    return j['challenge'], j.get('address')
+
+
+def register(session, url, pub, sign, challenge):
+    """POSTs the signed challenge, returns the response of the API"""
+
+    response = base64.b64encode(sign(base64.b64decode(challenge))).decode()
+
+    r = session.post(url + '/api', json={'pub': pub, 'challenge' : challenge, 'response': response}, timeout=30)
+
+    if r.status_code != 200:
+        raise APIError(r)
+
+    j = r.json()
+
+    if j.get('error') == 'revoked public key':
+        raise Revoked('{} is revoked'.format(j['name']))
+
+    return j
+
+
+def run_daemon(url, pub, sign, watch, probe, refresh, max_backoff):
+    """Keeps the record of the key pointing to the current address
+
+    The local address is checked every watch seconds (without traffic), and the
+    address seen by the server every probe seconds (a GET, which is cheap for it).
+    The key is registered again only when one of them changes, or every refresh
+    seconds. On errors it waits an exponential, jittered backoff (or the Retry-After
+    of the server), so many devices do not retry all at once.
+    """
+
+    session = requests.Session()
+
+    registered = None
+    registered_at = 0
+    probed_at = 0
+    current_local = None
+    backoff = 0
+
+    while True:
+
+        try:
+            previous_local = current_local
+            current_local = local_address(url)
+            due = time() - registered_at >= refresh
+
+            if current_local != previous_local or time() - probed_at >= probe or due:
+
+                challenge, address = get_challenge(session, url)
+                probed_at = time()
+
+                # older servers do not send the address: then only local changes and refresh count
+                changed = address != registered if address else current_local != previous_local
+
+                if changed or due:
+                    result = register(session, url, pub, sign, challenge)
+                    registered = address
+                    registered_at = time()
+                    log('{} -> {}'.format(result['name'], result['ip']))
+
+            backoff = 0
+            sleep(watch)
+
+        except Revoked as e:
+            log(e)
+            return False
+
+        except (requests.RequestException, socket.error, APIError, ValueError, KeyError) as e:
+            backoff = min(max(backoff * 2, watch), max_backoff)
+            wait = max(random.uniform(backoff / 2, backoff), getattr(e, 'retry_after', 0))
+            log('Error: {} (retrying in {:.0f}s)'.format(e, wait))
+            # probe again after the error, the address may have changed meanwhile
+            current_local = None
+            sleep(wait)
+
+
 @click.command()
 @click.option('-u', 'url', default='https://asydns.org', help='API URL')
 @click.option('-g', 'generate', is_flag=True, default=False, help='Force the generation of a new key pair')
 @click.option('-r', 'revoke', is_flag=True, default=False, help='Revoke the public key')
-def cmd_asydns(url, generate, revoke):
+@click.option('-t', 'key_type', default='rsa', type=click.Choice(['rsa', 'ed25519', 'ecdsa']), help='Key type (ed25519 and ecdsa need the cryptography package)')
+@click.option('-d', '--daemon', 'daemon', is_flag=True, default=False, help='Keep running, registering again when the address changes')
+@click.option('--watch', default=10, help='Daemon: seconds between checks of the local address')
+@click.option('--probe', default=300, help='Daemon: seconds between checks of the address seen by the server')
+@click.option('--refresh', default=6 * 3600, help='Daemon: seconds between registrations with no address change')
+@click.option('--max-backoff', 'max_backoff', default=900, help='Daemon: longest wait after errors, in seconds')
+def cmd_asydns(url, generate, revoke, key_type, daemon, watch, probe, refresh, max_backoff):
 
     dotdir = Path.home() / '.asydns'
 
     dotdir.mkdir(exist_ok=True)
 
-    pub_file = dotdir / 'rsa.pub'
-    key_file = dotdir / 'rsa.key'
+    pub_file = dotdir / '{}.pub'.format(key_type)
+    key_file = dotdir / '{}.key'.format(key_type)
 
 
     if generate or not key_file.is_file():
 
-        print('Generating RSA key ...')
-        random_generator = Random.new().read
-        key = RSA.generate(2048, random_generator)
-        pub = key.publickey()
+        print('Generating {} key ...'.format(key_type.upper()))
+        key_pem = generate_key(key_type)
 
         with key_file.open('w') as k:
-            k.write(key.exportKey('PEM').decode())
+            k.write(key_pem)
+
+        pub, sign = load_key(key_type, key_pem)
 
         with pub_file.open('w') as p:
-            p.write(pub.exportKey('PEM').decode())
+            p.write(pub)
 
 
-    print('Loading RSA key ...')
+    print('Loading {} key ...'.format(key_type.upper()))
     with key_file.open() as k:
-        key = RSA.importKey(k.read())
+        pub, sign = load_key(key_type, k.read())
 
-    with pub_file.open() as p:
-        pub = RSA.importKey(p.read())
+    if daemon and not revoke:
+        return run_daemon(url.rstrip('/'), pub, sign, watch, probe, refresh, max_backoff)
 
 
     r = requests.get(url + '/api')
@@ -56,14 +233,12 @@ def cmd_asydns(url, generate, revoke):
     j = r.json()
 
     challenge = base64.b64decode(j['challenge'])
-    signer = PKCS1_v1_5.new(key)
-    response = signer.sign(SHA224.new(challenge))
-    response = base64.b64encode(response).decode()
+    response = base64.b64encode(sign(challenge)).decode()
 
     if revoke:
-        r = requests.delete(url + '/api', json={'pub': pub.exportKey('PEM').decode(), 'challenge' : j['challenge'], 'response': response})
+        r = requests.delete(url + '/api', json={'pub': pub, 'challenge' : j['challenge'], 'response': response})
     else:
-        r = requests.post(url + '/api', json={'pub': pub.exportKey('PEM').decode(), 'challenge' : j['challenge'], 'response': response})
+        r = requests.post(url + '/api', json={'pub': pub, 'challenge' : j['challenge'], 'response': response})
 
     print(r.request.headers)
     print(r.request.body)
@@ -0,0 +1,399 @@
+import asyncio
+import json
+import logging
+import os
+import pwd
+import re
+import signal
+import socket
+import time
+from pathlib import Path
+
+import click
+from dnslib import AAAA, NS, QTYPE, RCODE, RR, SOA, A, DNSLabel, DNSRecord
+from dnslib.server import BaseResolver
+
+from backend.local import local_dir
+from backend.store import RecordStore
+
+
+def drop_privileges(new_user):
+    if os.getuid() != 0:
+        return
+
+    pwnam = pwd.getpwnam(new_user)
+
+    # Remove group privileges
+    os.setgroups([])
+
+    # Try setting the new uid/gid
+    os.setgid(pwnam.pw_gid)
+    os.setuid(pwnam.pw_uid)
+
+    #Ensure a reasonable umask
+    old_umask = os.umask(0o22)
+
+    return True
+
+
+def load_config(user):
+
+    config_file = Path(pwd.getpwnam(user).pw_dir) / '.asydns' / 'config.json'
+
+    try:
+        with config_file.open() as c:
+            return json.loads(c.read())
+    except Exception:
+        raise Exception('InvalidConfigFile', 'Error loading config file {}. Please, provide a valid JSON'.format(config_file))
+
+
+class AsymResolver(BaseResolver):
+
+    def __init__(self, config, store):
+        """Authoritative resolver for the Local backend
+
+        Answers straight from the memory-mapped RecordStore that the REST API writes,
+        so there is no filesystem I/O on the query path.
+        """
+
+        self.config = config
+        self.store = store
+
+        self.domain = DNSLabel(self.config['domain'].rstrip('.'))
+        self.ttl = self.config.get('dns_ttl', 30)
+        self.expire = self.config.get('record_expire', 0)
+
+        self.regex_sha224 = re.compile('^(r-)?([0-9a-f]{56})$')
+
+        self.registers = { DNSLabel(k): v for k,v in self.config.get('registers', {}).items() }
+
+        ns = sorted(self.registers.keys()) or [ self.domain.add('ns1') ]
+
+        self.ns = [ RR(self.domain, QTYPE.NS, rdata=NS(n), ttl=3600) for n in ns ]
+        negative_ttl = self.config.get('dns_negative_ttl', 60)
+
+        soa = SOA(
+            ns[0],
+            self.domain.add(self.config.get('soa_rname', 'hostmaster')),
+            (int(time.time()), 3600, 600, 86400, negative_ttl),
+        )
+
+        self.soa = RR(self.domain, QTYPE.SOA, ttl=3600, rdata=soa)
+
+        # RFC 2308: negative answers are cached for min(SOA TTL, SOA minimum)
+        self.negative_soa = RR(self.domain, QTYPE.SOA, ttl=min(3600, negative_ttl), rdata=soa)
+
+
+    def registry(self, qname):
+        """Returns (registry, revocation name) if qname is <sha224> or r-<sha224> in our domain"""
+
+        if len(qname.label) != len(self.domain.label) + 1 or DNSLabel(qname.label[1:]) != self.domain:
+            return None
+
+        match = self.regex_sha224.match(qname.label[0].decode().lower())
+
+        if not match:
+            return None
+
+        revoked, registry = match.groups()
+
+        return registry, bool(revoked)
+
+
+    def _address(self, qname):
+        """Returns the address for qname, None if there is no such name"""
+
+        if qname in self.registers:
+            return self.registers[qname]
+
+        name = self.registry(qname)
+
+        if not name:
+            return None
+
+        registry, revocation = name
+        current = self.store.get(registry)
+
+        if not current:
+            return None
+
+        address, updated, revoked = current
+
+        if revocation:
+            return '127.0.0.1' if revoked else None
+
+        if revoked or (self.expire and time.time() - updated > self.expire):
+            return None
+
+        return address
+
+
+    def resolve(self, request, handler):
+
+        reply = request.reply(ra=0)
+        qname = request.q.qname
+        qtype = request.q.qtype
+
+        if not qname.matchSuffix(self.domain):
+            reply.header.rcode = RCODE.REFUSED
+            return reply
+
+        if qname == self.domain:
+            if qtype in [QTYPE.SOA, QTYPE.ANY]:
+                reply.add_answer(self.soa)
+            if qtype in [QTYPE.NS, QTYPE.ANY]:
+                reply.add_answer(*self.ns)
+            if not reply.rr:
+                reply.add_auth(self.negative_soa)
+            return reply
+
+        address = self._address(qname)
+
+        if address is None:
+            reply.header.rcode = RCODE.NXDOMAIN
+            reply.add_auth(self.negative_soa)
+            return reply
+
+        if ':' in address and qtype in [QTYPE.AAAA, QTYPE.ANY]:
+            reply.add_answer(RR(qname, QTYPE.AAAA, rdata=AAAA(address), ttl=self.ttl))
+        elif ':' not in address and qtype in [QTYPE.A, QTYPE.ANY]:
+            reply.add_answer(RR(qname, QTYPE.A, rdata=A(address), ttl=self.ttl))
+        else:
+            reply.add_auth(self.negative_soa)
+
+        return reply
+
+
+def parse_question(data):
+    """Returns the offset where the question of a plain query ends, or None
+
+    Only standard queries with one question and no answers/authority are considered
+    (the additional section may have an EDNS OPT record, it is ignored).
+    """
+
+    if len(data) < 17 or data[2] & 0xf8 or data[4:10] != b'\x00\x01\x00\x00\x00\x00':
+        return None
+
+    offset = 12
+
+    while True:
+        length = data[offset]
+        if length == 0:
+            break
+        if length > 63:
+            return None
+        offset += length + 1
+        if offset >= len(data) or offset > 12 + 255:
+            return None
+
+    end = offset + 5
+
+    if end > len(data):
+        return None
+
+    return end
+
+
+class AnswerCache():
+
+    def __init__(self, config, resolver):
+        """Packed replies, keyed by the lowercase question (qname + qtype + qclass)
+
+        A cached reply is served by patching the transaction id, the RD flag and the
+        question (so the 0x20 case of the query is kept) into the cached bytes.
+
+        Replies for registry names remember the version of the record they were built
+        from (its seq in the store, or the record count for names that did not exist)
+        and are only served while the store still has that version.
+        """
+
+        self.resolver = resolver
+        self.store = resolver.store
+        self.max_entries = config.get('dns_cache_entries', 100000)
+        self.entries = {}
+
+
+    def version(self, qname):
+        """Version of the data behind qname, taken before resolving it"""
+
+        name = self.resolver.registry(qname)
+
+        if not name:
+            return None
+
+        digest = bytes.fromhex(name[0])
+        number = self.store.lookup(digest)
+
+        if number is None:
+            return digest, None, self.store.count()
+
+        return digest, number, self.store.seq(number)
+
+
+    def _valid(self, version):
+
+        if version is None:
+            return True
+
+        digest, number, seq = version
+
+        if number is not None:
+            return self.store.seq(number) == seq
+
+        return self.store.count() == seq or self.store.lookup(digest) is None
+
+
+    def get(self, data, end):
+
+        key = data[12:end].lower()
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        header, tail, version, deadline = entry
+
+        if (deadline and time.time() > deadline) or not self._valid(version):
+            del self.entries[key]
+            return None
+
+        return data[:2] + bytes([header[0] | (data[2] & 0x01)]) + header[1:] + data[12:end] + tail
+
+
+    def put(self, data, end, reply, packed, version):
+
+        if reply.header.rcode not in [RCODE.NOERROR, RCODE.NXDOMAIN] or reply.header.tc:
+            return
+
+        if len(self.entries) >= self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+        deadline = None
+
+        if version and version[1] is not None and self.resolver.expire:
+            address, updated, flags, seq = self.store.read(version[1])
+            deadline = updated + self.resolver.expire
+
+        self.entries[data[12:end].lower()] = (bytes([packed[2] & 0xfe]) + packed[3:12], packed[end:], version, deadline)
+
+
+class DNSProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, resolver, cache):
+        self.resolver = resolver
+        self.cache = cache
+        self.logger = logging.getLogger('asydnsd')
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, addr):
+
+        end = parse_question(data)
+
+        if end:
+            cached = self.cache.get(data, end)
+            if cached:
+                self.transport.sendto(cached, addr)
+                return
+
+        try:
+            request = DNSRecord.parse(data)
+        except Exception:
+            # not a DNS query, nothing to answer
+            return
+
+        try:
+            version = self.cache.version(request.q.qname)
+            reply = self.resolver.resolve(request, None)
+        except Exception as e:
+            self.logger.error(e)
+            reply = request.reply(ra=0)
+            reply.header.rcode = RCODE.SERVFAIL
+
+        packed = reply.pack()
+
+        if end and reply.header.rcode != RCODE.SERVFAIL:
+            self.cache.put(data, end, reply, packed, version)
+
+        self.transport.sendto(packed, addr)
+
+
+def bind(address, port):
+    """UDP socket with SO_REUSEPORT, so every worker gets its own queue from the kernel"""
+
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    sock.setblocking(False)
+
+    return sock
+
+
+def serve(sock, user, config):
+    """Runs one worker: drops privileges and serves queries from sock until killed"""
+
+    drop_privileges(user)
+
+    store = RecordStore(local_dir(config, user), writable=False)
+    resolver = AsymResolver(config, store)
+    cache = AnswerCache(config, resolver)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    loop.run_until_complete(loop.create_datagram_endpoint(lambda: DNSProtocol(resolver, cache), sock=sock))
+    loop.run_forever()
+
+
+@click.command()
+@click.argument('user')
+@click.option('-a', 'address', default='0.0.0.0', help='Address to listen on')
+@click.option('-p', 'port', default=53, help='UDP port to listen on')
+@click.option('-w', 'workers', default=1, help='Worker processes (0: one per core)')
+def cmd_dnsd(user, address, port, workers):
+    """Serves the records of the Local backend, running as USER after binding"""
+
+    config = load_config(user)
+
+    workers = workers or os.cpu_count() or 1
+
+    # every socket is bound here, while we still have the privileges to use port 53
+    socks = [ bind(address, port) for i in range(workers) ]
+
+    if workers == 1:
+        serve(socks[0], user, config)
+        return
+
+    children = []
+
+    for sock in socks:
+        pid = os.fork()
+        if pid == 0:
+            serve(sock, user, config)
+            os._exit(0)
+        children.append(pid)
+        sock.close()
+
+    drop_privileges(user)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    cmd_dnsd()
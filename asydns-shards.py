@@ -0,0 +1,80 @@
+import json
+import os
+import pwd
+from collections import Counter
+from pathlib import Path
+
+import click
+
+from backend.sharded import ShardedBackend
+
+
+def move(source, target, registry, address, revoked, dry_run):
+    """Moves one record from the source backend to the target backend"""
+
+    if dry_run:
+        return
+
+    if revoked:
+        target.revoke(registry)
+    elif target.check(registry)['status'] == 'non-registered':
+        # if the API already wrote it to the new shard, that address is the newer one
+        target.update(registry, address)
+
+    source.delete(registry, address, revoked)
+
+
+@click.command()
+@click.option('-c', 'config_file', default=None, help='Config file (default: ~/.asydns/config.json)')
+@click.option('-n', 'dry_run', is_flag=True, default=False, help='Only show what would be moved')
+def cmd_rebalance(config_file, dry_run):
+    """Moves the records of a Sharded backend to the shard that owns them
+
+    Change the prefixes of 'shards' in the config and keep the old layout in
+    'shards_previous' while this runs (so the API still finds the revocations
+    that were not moved yet). Remove 'shards_previous' when it finishes.
+    """
+
+    if not config_file:
+        config_file = Path(pwd.getpwuid(os.getuid()).pw_dir) / '.asydns' / 'config.json'
+
+    with Path(config_file).open() as c:
+        config = json.loads(c.read())
+
+    if config.get('backend') != 'Sharded':
+        raise click.ClickException('The config file does not use the Sharded backend')
+
+    sharded = ShardedBackend(config)
+    moved = Counter()
+
+    for name, source in sharded.backends.items():
+
+        if not hasattr(source, 'records'):
+            click.echo('{}: this backend can not list its records, skipping'.format(name))
+            continue
+
+        for registry, revoked, address in source.records():
+            owner = sharded.map.shard(registry)
+            if owner == name:
+                continue
+            move(source, sharded.backends[owner], registry, address, revoked, dry_run)
+            moved[(name, owner)] += 1
+
+        # revocations that only live in the revocation index (no r- record in the zone)
+        if getattr(source, 'revocations', None) is not None:
+            for registry in source.revocations:
+                owner = sharded.map.shard(registry)
+                if owner == name or sharded.backends[owner].check(registry)['status'] == 'revoked':
+                    continue
+                if not dry_run:
+                    sharded.backends[owner].revoke(registry)
+                moved[(name, owner)] += 1
+
+    for (name, owner), count in sorted(moved.items()):
+        click.echo('{} -> {}: {} records{}'.format(name, owner, count, ' (dry run)' if dry_run else ''))
+
+    click.echo('{} records moved'.format(sum(moved.values())))
+
+
+if __name__ == "__main__":
+    cmd_rebalance()
@@ -0,0 +1,313 @@
+import ipaddress
+import json
+import os
+import pwd
+import re
+import sys
+from collections import Counter
+from pathlib import Path
+from time import sleep, time
+
+import click
+
+from asydnsd import backend_mapping
+from backend.batcher import retryable
+
+
+REGISTRY = re.compile('^[0-9a-f]{56}$')
+
+# value of the r- records that mark the revocations in a zone file (as in Route53)
+REVOKED_ADDRESS = '127.0.0.1'
+
+
+def valid_address(address):
+
+    try:
+        ipaddress.ip_address(address)
+    except ValueError:
+        return False
+
+    return True
+
+
+def load_backend(config_file):
+    """Returns (config, backend) for a config file (default: ~/.asydns/config.json)"""
+
+    if not config_file:
+        config_file = Path(pwd.getpwuid(os.getuid()).pw_dir) / '.asydns' / 'config.json'
+
+    with Path(config_file).open() as c:
+        config = json.loads(c.read())
+
+    backend_class = backend_mapping.get(config.get('backend'))
+
+    if not backend_class:
+        raise click.ClickException('Invalid backend. Options: {}'.format(','.join(backend_mapping.keys())))
+
+    backend = backend_class(config)
+
+    if not hasattr(backend, 'dump'):
+        raise click.ClickException('The {} backend can not list its records'.format(config['backend']))
+
+    return config, backend
+
+
+def write_ndjson(records, out, origin, ttl):
+    """Writes the records as JSON lines ({"r": hash, "a": address} or {"r": hash, "revoked": true}), returns how many"""
+
+    count = 0
+
+    for registry, revoked, address in records:
+        entry = { 'r': registry, 'revoked': True } if revoked else { 'r': registry, 'a': address }
+        out.write(json.dumps(entry) + '\n')
+        count += 1
+
+    return count
+
+
+def write_zone(records, out, origin, ttl):
+    """Writes the records as an RFC 1035 zone file, returns how many"""
+
+    out.write('$ORIGIN {}\n$TTL {}\n'.format(origin, ttl))
+
+    count = 0
+
+    for registry, revoked, address in records:
+        if revoked:
+            out.write('r-{} IN A {}\n'.format(registry, REVOKED_ADDRESS))
+        else:
+            out.write('{} IN {} {}\n'.format(registry, 'AAAA' if ':' in address else 'A', address))
+        count += 1
+
+    return count
+
+
+def read_ndjson(lines):
+    """Yields (line number, (registry, revoked, address) or None if the line is not valid)"""
+
+    for number, line in enumerate(lines, 1):
+
+        if not line.strip():
+            yield number, None
+            continue
+
+        try:
+            entry = json.loads(line)
+            yield number, (entry['r'], bool(entry.get('revoked')), entry.get('a'))
+        except (ValueError, KeyError, TypeError):
+            yield number, None
+
+
+def read_zone(lines):
+    """Like read_ndjson, for the A/AAAA records of a zone file (one record per line)"""
+
+    origin = ''
+
+    for number, line in enumerate(lines, 1):
+
+        fields = line.split(';', 1)[0].split()
+
+        if not fields or fields[0] == '$TTL':
+            yield number, None
+            continue
+
+        if fields[0] == '$ORIGIN' and len(fields) > 1:
+            origin = '.' + fields[1].rstrip('.').lower() + '.'
+            yield number, None
+            continue
+
+        fields = [ f for f in fields if f.upper() != 'IN' and not f.isdigit() ]
+
+        if len(fields) != 3 or fields[1].upper() not in ['A', 'AAAA']:
+            yield number, None
+            continue
+
+        name, rtype, address = fields
+        name = name.lower()
+
+        if name.endswith('.'):
+            if not origin or not name.endswith(origin):
+                yield number, None
+                continue
+            name = name[:-len(origin)]
+
+        if name.startswith('r-'):
+            yield number, (name[2:], True, None)
+        else:
+            yield number, (name, False, address)
+
+
+def read_checkpoint(path):
+
+    if not path or not path.is_file():
+        return 0
+
+    with path.open() as f:
+        return json.load(f)['line']
+
+
+def write_checkpoint(path, line):
+
+    tmp = path.with_suffix('.tmp')
+
+    with tmp.open('w') as f:
+        json.dump({ 'line': line }, f)
+
+    os.replace(str(tmp), str(path))
+
+
+def apply_batch(backend, batch, check, counts):
+    """Applies a batch of entries: the revocations first, then the updates in one call"""
+
+    updates = {}
+
+    for registry, revoked, address in batch:
+        if revoked:
+            backend.revoke(registry)
+            counts['revoked'] += 1
+        else:
+            updates[registry] = address
+
+    for registry in list(updates):
+        # an update would replace the revocation of a Local record
+        if check and backend.check(registry)['status'] == 'revoked':
+            del updates[registry]
+            counts['skipped_revoked'] += 1
+
+    if not updates:
+        return
+
+    if hasattr(backend, 'update_many'):
+        backend.update_many(list(updates.items()))
+    else:
+        for registry, address in updates.items():
+            backend.update(registry, address)
+
+    counts['registered'] += len(updates)
+
+
+def apply_with_retry(backend, batch, check, counts):
+    """apply_batch, waiting and trying again while the backend asks to (e.g. throttling)"""
+
+    backoff = 1
+
+    while True:
+        try:
+            return apply_batch(backend, batch, check, counts)
+        except Exception as e:
+            if not retryable(e):
+                raise
+            wait = getattr(e, 'retry_after', None) or backoff
+            click.echo('{}, retrying in {}s'.format(e, wait), err=True)
+            sleep(wait)
+            backoff = min(backoff * 2, 60)
+
+
+@click.group()
+def cli():
+    """Exports and imports the records of an AsyDNS backend"""
+
+
+@cli.command('export')
+@click.option('-c', 'config_file', default=None, help='Config file (default: ~/.asydns/config.json)')
+@click.option('-f', 'fmt', default='ndjson', type=click.Choice(['ndjson', 'zone']), help='Output format')
+@click.option('-o', 'output', default='-', help='Output file (default: stdout)')
+def cmd_export(config_file, fmt, output):
+    """Writes every registration and revocation of the backend
+
+    The records are streamed (a page of Route53 records at a time), so memory does
+    not grow with the size of the zone. In zone files, revocations are r- records.
+    """
+
+    config, backend = load_backend(config_file)
+
+    writer = write_ndjson if fmt == 'ndjson' else write_zone
+    origin = config['domain'].rstrip('.') + '.'
+
+    out = sys.stdout if output == '-' else open(output, 'w')
+
+    try:
+        count = writer(backend.dump(), out, origin, config.get('ttl', 300))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    click.echo('{} records exported'.format(count), err=True)
+
+
+@cli.command('import')
+@click.option('-c', 'config_file', default=None, help='Config file of the target backend (default: ~/.asydns/config.json)')
+@click.option('-f', 'fmt', default='ndjson', type=click.Choice(['ndjson', 'zone']), help='Input format')
+@click.option('-i', 'input_file', default='-', help='Input file (default: stdin)')
+@click.option('-b', 'batch_size', default=500, help='Records per write')
+@click.option('-r', 'rate', default=0.0, help='Records per second at most (0: no limit)')
+@click.option('-k', 'checkpoint', default=None, help='Checkpoint file: resume from it, and update it after every batch')
+@click.option('--no-check', 'no_check', is_flag=True, default=False, help='Do not look for revocations in the target before each update (only for an empty target)')
+def cmd_import(config_file, fmt, input_file, batch_size, rate, checkpoint, no_check):
+    """Loads an export into a backend
+
+    Revocations are applied, and registrations are written in batches (one
+    ChangeBatch per batch on Route53). With -k, the last line applied is saved
+    after every batch, so an interrupted import can be run again with the same
+    input and checkpoint and goes on from there.
+    """
+
+    config, backend = load_backend(config_file)
+
+    checkpoint = Path(checkpoint) if checkpoint else None
+    done = read_checkpoint(checkpoint)
+
+    if done:
+        click.echo('Resuming after line {}'.format(done), err=True)
+
+    reader = read_ndjson if fmt == 'ndjson' else read_zone
+    source = sys.stdin if input_file == '-' else open(input_file)
+
+    counts = Counter()
+    batch = []
+    start = time()
+    last = done
+
+    def flush(line):
+        apply_with_retry(backend, batch, not no_check, counts)
+        batch.clear()
+        if checkpoint:
+            write_checkpoint(checkpoint, line)
+        applied = sum([ counts[k] for k in ['registered', 'revoked', 'skipped_revoked'] ])
+        if rate:
+            sleep(max(0, start + applied / rate - time()))
+        click.echo('line {}: {}'.format(line, dict(counts)), err=True)
+
+    try:
+        for number, entry in reader(source):
+
+            if number <= done:
+                continue
+
+            last = number
+
+            if entry is None:
+                continue
+
+            registry, revoked, address = entry
+
+            if not REGISTRY.match(registry) or (not revoked and not valid_address(address)):
+                counts['invalid'] += 1
+                continue
+
+            batch.append(entry)
+
+            if len(batch) >= batch_size:
+                flush(number)
+
+        if batch or last > done:
+            flush(last)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+    click.echo('{} records imported ({})'.format(counts['registered'] + counts['revoked'], dict(counts)), err=True)
+
+
+if __name__ == '__main__':
+    cli()
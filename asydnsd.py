@@ -1,30 +1,69 @@
+import asyncio
 import base64
+import fcntl
+import hashlib
+import ipaddress
 import json
 import os
 import pwd
 import re
 import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from threading import Event, Lock, Thread
 from time import time
 import logging
 
 import falcon
+try:
+    import falcon.asgi as falcon_asgi
+except ImportError:
+    falcon_asgi = None
 from Crypto import Random
-from Crypto.Hash import SHA224
 from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
 
+from backend.aio import AsyncBackend
+from backend.local import LocalBackend
 from backend.route53 import Route53Backend
+from backend.sharded import ShardedBackend
+from challenges import Challenger
+from cryptopool import CryptoPool, PoolBusy, verify_response
+from journal import Journal
+from keycache import InvalidKeySize, KeyCache, key_types
+from metrics import OUTCOMES, PHASE, Metrics, MetricsMiddleware
+from ratelimit import rate_limiter
+from replay import ReplayGuard
 
 
+# longest challenge accepted (RSA ones are as long as the server key)
+MAX_CHALLENGE = 1024
+
+# Ed25519 signatures are 64 bytes and ECDSA P-256 ones (DER) up to 72
+MAX_EC_SIGNATURE = 72
+
 backend_mapping = {
     'Route53' : Route53Backend,
+    'Local' : LocalBackend,
+    'Sharded' : ShardedBackend,
 }
 
 
 class AsyDNS():
 
-    def __init__(self):
+    def __init__(self, dotdir=None, config=None, backend=None):
+        """The REST API resource
+
+        dotdir (default: ~/.asydns) has the config file and the server keys. The config
+        and the backend can also be given, instead of loading them from there (that is
+        what the benchmarks do, to use a fake Route53 client).
+
+        Building it is cheap, so it can be done once in the gunicorn master (--preload)
+        and shared by the workers: the backend, the journal and the crypto pool (with
+        their threads, clients and processes) are built by each process the first time
+        they are used, and missing server keys are generated in the background (the
+        API answers 503 until they are ready, see /ready).
+        """
 
         user = pwd.getpwuid(os.getuid())
 
@@ -32,13 +71,14 @@ class AsyDNS():
 
         self.code_dir = Path(__file__).parent
 
-        dotdir = self.home_dir / '.asydns'
-        dotdir.mkdir(exist_ok=True)
+        self.dotdir = Path(dotdir) if dotdir else self.home_dir / '.asydns'
+        self.dotdir.mkdir(exist_ok=True)
 
-        config_file = dotdir / 'config.json'
+        config_file = self.dotdir / 'config.json'
 
-        pub_file = dotdir / 'server.pub'
-        key_file = dotdir / 'server.key'
+        self.pub_file = self.dotdir / 'server.pub'
+        self.key_file = self.dotdir / 'server.key'
+        self.secret_file = self.dotdir / 'challenge.key'
 
         self.logger = logging.getLogger('asydnsd')
         self.logger.setLevel(logging.DEBUG)
@@ -51,127 +91,609 @@ class AsyDNS():
 
         self.regex_sha224 = re.compile('[0-9a-f]{56}')
 
-        if not config_file.is_file():
-            raise Exception('NoConfigFile', 'No config file. Please, create it in: {}'.format(str(config_file)))
+        self.stats = Counter()
 
-        try:
-            with config_file.open() as c:
-                self.config = json.loads(c.read())
-        except Exception:
-            raise Exception('InvalidConfigFile', 'Error loading config file. Please, provide a valid JSON')
+        if config is None:
+
+            if not config_file.is_file():
+                raise Exception('NoConfigFile', 'No config file. Please, create it in: {}'.format(str(config_file)))
 
-        backend_class = backend_mapping.get(self.config['backend'], None)
-        self.backend = backend_class(self.config)
+            try:
+                with config_file.open() as c:
+                    config = json.loads(c.read())
+            except Exception:
+                raise Exception('InvalidConfigFile', 'Error loading config file. Please, provide a valid JSON')
 
-        if not self.backend:
+        self.config = config
+
+        self.metrics = Metrics(self.config)
+
+        if backend is None and self.config.get('backend') not in backend_mapping:
             raise Exception('NoBackend', 'Please, define a backend. Options: {}'.format(','.join(backend_mapping.keys())))
 
-        if not key_file.is_file():
+        self._backend = backend
+
+        self._process = {}
+        self._process_lock = Lock()
+
+        self.key = None
+        self.pub = None
+        self.challenger = None
+        self.keys_ready = Event()
+
+        if self.key_file.is_file():
+            self._load_keys()
+        else:
+            Thread(target=self._load_keys, daemon=True).start()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forked)
+
+        self.keys = KeyCache(self.config)
+
+        self.challenge_window = int(self.config.get('challenge_window', 30))
+        self.challenge_skew = int(self.config.get('challenge_skew', 1))
+
+        self.max_body = int(self.config.get('max_body_bytes', 8192))
+        self.key_min_bits = int(self.config.get('client_key_min_bits', 1024))
+        self.key_max_bits = int(self.config.get('client_key_max_bits', 4096))
+        self.ec_keys = [ t for t in key_types(self.config) if t != 'rsa' ]
+
+        self.stages = [
+            ('ready', self._check_ready),
+            ('size', self._check_size),
+            ('shape', self._check_shape),
+            ('replay', self._check_replay),
+            ('key', self._check_key_size),
+            ('time', self._check_time),
+            ('address', self._check_address),
+            ('rate', self._check_rate),
+            ('crypto', self._check_signature),
+            # RSA challenges are only opened by the crypto stage, so their time and
+            # address are checked after it
+            ('time', self._check_time),
+            ('address', self._check_address),
+            # only a valid signature spends a token of the key
+            ('rate', self._take_rate),
+            ('replay', self._mark_used),
+        ]
+
+        self.batch_max = int(self.config.get('batch_max', 100))
+        self.batch_max_body = int(self.config.get('batch_max_body_bytes', self.max_body * self.batch_max))
+        self.batch_custom_address = self.config.get('batch_custom_address', False)
+        self.batch_executor = ThreadPoolExecutor(max_workers=self.config.get('batch_threads', 2 * (os.cpu_count() or 1)))
+
+        self.address_limiter = None
+        self.key_limiter = None
+
+        if self.config.get('ratelimit', True):
+            self.address_limiter = rate_limiter(self.config, 'address',
+                self.config.get('ratelimit_address_rate', 1), self.config.get('ratelimit_address_burst', 20))
+            self.key_limiter = rate_limiter(self.config, 'key',
+                self.config.get('ratelimit_key_rate', 0.1), self.config.get('ratelimit_key_burst', 10))
+
+        self.replay = None
+
+        if self.config.get('replay_protection', True):
+            self.replay = ReplayGuard(self.config)
+
+
+
+    def _load_keys(self):
+        """Loads the server keys, generating them first if there are none
+
+        The key file is locked meanwhile, so when several workers start without keys,
+        only one generates them and the others wait and load them.
+        """
+
+        try:
+            with self.key_file.with_suffix('.lock').open('w') as lock:
+
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                try:
+                    self._read_keys()
+                finally:
+                    # explicitly, as a process forked meanwhile holds a copy of the file
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        except Exception as e:
+            self.logger.error(e)
+            raise
+
+        self.keys_ready.set()
+
+
+    def _read_keys(self):
+        """Reads the server keys (generating them if there are none) and builds the challenger"""
+
+        if not self.key_file.is_file():
+
+            self.logger.info('Generating the server keys')
 
             random_generator = Random.new().read
             key = RSA.generate(2048, random_generator)
             pub = key.publickey()
 
-            with key_file.open('w') as k:
-                k.write(key.exportKey('PEM').decode())
-
-            with pub_file.open('w') as p:
+            with self.pub_file.open('w') as p:
                 p.write(pub.exportKey('PEM').decode())
 
+            tmp = self.key_file.with_suffix('.tmp')
+
+            with tmp.open('w') as k:
+                os.chmod(str(tmp), 0o600)
+                k.write(key.exportKey('PEM').decode())
+
+            os.replace(str(tmp), str(self.key_file))
 
-        with key_file.open() as k:
+        with self.key_file.open() as k:
             self.key = RSA.importKey(k.read())
 
-        with pub_file.open() as p:
+        with self.pub_file.open() as p:
             self.pub = RSA.importKey(p.read())
 
+        self.challenger = Challenger(self.config, self.key, self.secret_file)
+
+
+    def _forked(self):
+        """In a forked worker, drops what belongs to the parent process
+
+        Threads do not survive a fork, so the backend, the journal and the crypto pool
+        are built again on first use, and the keys are loaded by this process if the
+        parent had not finished.
+        """
+
+        self._process = {}
+        self._process_lock = Lock()
+
+        if not self.keys_ready.is_set():
+            Thread(target=self._load_keys, daemon=True).start()
+
 
-    def _validate_response(self, req):
+    def _per_process(self, name, factory):
+        """Returns the object built by factory for this process (built on first use)"""
+
+        if name not in self._process:
+            with self._process_lock:
+                if name not in self._process:
+                    self._process[name] = factory()
+
+        return self._process[name]
+
+
+    def _create_backend(self):
+
+        backend = self._backend
+
+        if backend is None:
+            backend = backend_mapping[self.config['backend']](self.config)
+
+        if hasattr(backend, 'set_metrics'):
+            backend.set_metrics(self.metrics)
+
+        return backend
+
+
+    @property
+    def backend(self):
+
+        return self._per_process('backend', self._create_backend)
+
+
+    @property
+    def journal(self):
+
+        if not self.config.get('journal', False):
+            return None
+
+        return self._per_process('journal', lambda: Journal(self.config, self.backend, self.dotdir / 'journal'))
+
+
+    @property
+    def crypto_pool(self):
+
+        if not self.config.get('crypto_workers'):
+            return None
+
+        return self._per_process('crypto_pool', lambda: CryptoPool(self.config, self.key_file, self.secret_file))
+
+
+    def _readiness(self):
+        """Returns (ready, body) for /ready: the server keys are loaded and the backend works"""
+
+        body = { 'keys': self.keys_ready.is_set(), 'backend': False }
 
         try:
-            body = req.stream.read()
-            data = json.loads(body.decode('utf-8'))
-            challenge = base64.b64decode(data['challenge'])
-            response = base64.b64decode(data['response'])
-            client_pub = RSA.importKey(data['pub'])
-            decrypted_challenge = self.key.decrypt(challenge).decode()
-            challenge_addr, challenge_time, junk = decrypted_challenge.split('@', maxsplit=2)
-            delta = int(challenge_time) - time()
+            ready = getattr(self.backend, 'ready', None)
+            body['backend'] = ready() if ready else True
         except Exception as e:
             self.logger.error(e)
-            return { 'status': falcon.HTTP_400, 'error': 'Invalid request' }
+            body['error'] = str(e)
+
+        body['ready'] = body['keys'] and body['backend']
+
+        return body['ready'], body
+
+
+    def _not_ready(self):
+        """Returns the rejection for the requests that arrive before the server keys are ready"""
+
+        if not self.keys_ready.is_set():
+            self._outcome('Server starting')
+            return { 'status': falcon.HTTP_503, 'error': 'Server starting', 'retry_after': 1 }
+
+
+    def _address(self, req):
+
+        return req.get_header('X-FORWARDED-FOR') or req.remote_addr
+
+
+    def _read_body(self, req):
+        """Reads the request body, one byte past max_body_bytes at most"""
+
+        return req.bounded_stream.read(self.max_body + 1)
+
+
+    def _check_ready(self, request):
+
+        if not self.keys_ready.is_set():
+            request['retry_after'] = 1
+            return falcon.HTTP_503, 'Server starting'
+
+
+    def _check_size(self, request):
+
+        if len(request['body']) > self.max_body:
+            return falcon.HTTP_413, 'Request too large'
+
+
+    def _check_shape(self, request):
+
+        data = json.loads(request['body'].decode('utf-8'))
+
+        if not isinstance(data, dict) or not all([ isinstance(data.get(f), str) for f in ['pub', 'challenge', 'response'] ]):
+            return falcon.HTTP_400, 'Invalid request'
+
+        request['pub'] = data['pub']
+        # line-wrapped base64 (e.g. the output of openssl or base64) is fine
+        request['challenge'] = base64.b64decode(''.join(data['challenge'].split()), validate=True)
+        request['response'] = base64.b64decode(''.join(data['response'].split()), validate=True)
+        request['digest'] = hashlib.sha224(request['challenge']).digest()
+
+        if not request['challenge'] or len(request['challenge']) > MAX_CHALLENGE:
+            return falcon.HTTP_400, 'Invalid request'
+
+
+    def _check_replay(self, request):
 
-        h = SHA224.new(challenge)
-        verifier = PKCS1_v1_5.new(client_pub)
+        if self.replay and self.replay.seen(request['digest']):
+            return falcon.HTTP_400, 'Replayed response'
 
-        if not verifier.verify(h, response):
-            return { 'status': falcon.HTTP_400, 'error': 'Invalid signature' }
 
-        if challenge_addr != req.headers.get('X-FORWARDED-FOR', req.remote_addr):
-            return { 'status': falcon.HTTP_400, 'error': 'Invalid response' }
+    def _check_key_size(self, request):
+        """Rejects signatures too short or too long for the accepted keys, before the crypto work
 
-        if delta > 30:
-            return { 'status': falcon.HTTP_400, 'error': 'Expired response' }
+        A short signature can also come from a small RSA key: the key cache rejects those
+        by the size of the key itself, in the crypto stage.
+        """
 
-        sha224 = SHA224.new(client_pub.exportKey(format='DER')).hexdigest()
+        if len(request['response']) <= MAX_EC_SIGNATURE:
+            if not self.ec_keys:
+                return falcon.HTTP_400, 'Invalid key size'
+            return
+
+        # a PKCS#1 v1.5 signature is exactly as long as the modulus of the client key
+        bits = len(request['response']) * 8
+
+        if bits < self.key_min_bits or bits > self.key_max_bits:
+            return falcon.HTTP_400, 'Invalid key size'
+
+
+    def _check_time(self, request):
+
+        if not request.get('opened'):
+            request['opened'] = self.challenger.peek(request['challenge'])
+            if not request['opened']:
+                return
+
+        age = time() - int(request['opened'][1])
+
+        if age > self.challenge_window or age < -self.challenge_skew:
+            return falcon.HTTP_400, 'Expired response'
+
+
+    def _check_address(self, request):
+
+        if request['opened'] and request['opened'][0] != request['address']:
+            return falcon.HTTP_400, 'Invalid response'
+
+
+    def _check_rate(self, request):
+        """Rejects keys with an empty bucket before the crypto work, without taking a token
+
+        Only for the keys already seen (in the key cache, or verified by the crypto pool),
+        so the key is not imported here (out of the crypto pool) just for this.
+        """
+
+        if not self.key_limiter:
+            return
+
+        sha224 = self.keys.name(request['pub'])
+
+        if sha224:
+            request['retry_after'] = self.key_limiter.peek(sha224)
+
+        if request.get('retry_after'):
+            return falcon.HTTP_429, 'Too many requests'
+
+
+    def _take_rate(self, request):
+
+        if not self.key_limiter:
+            return
+
+        request['retry_after'] = self.key_limiter.take(request['sha224'])
+
+        if request['retry_after']:
+            return falcon.HTTP_429, 'Too many requests'
+
+
+    def _check_signature(self, request):
+
+        args = (request['pub'], request['challenge'], request['response'])
+
+        try:
+            if self.crypto_pool:
+                result = self.crypto_pool.verify(*args)
+            else:
+                result = verify_response(self.challenger, self.keys, *args, self.metrics)
+        except InvalidKeySize:
+            return falcon.HTTP_400, 'Invalid key size'
+
+        challenge_addr, challenge_time, sha224, cached = result
+
+        self.stats['key_cache_hits' if cached else 'key_cache_misses'] += 1
+
+        if not sha224:
+            return falcon.HTTP_400, 'Invalid signature'
+
+        if self.crypto_pool:
+            # the pool loaded the key, this process only learns its name (for _check_rate)
+            self.keys.remember(request['pub'], sha224)
+
+        request['sha224'] = sha224
+        request['opened'] = (challenge_addr, challenge_time)
+
+
+    def _mark_used(self, request):
+
+        if self.replay and not self.replay.add(request['digest']):
+            return falcon.HTTP_400, 'Replayed response'
+
+
+    def _validate_response(self, body, address):
+        """Validates the body of a POST/DELETE request made from address
+
+        Runs the checks of self.stages in order, the cheap ones first, so junk is
+        rejected before any RSA work. Rejections are counted in stats, per stage
+        (rejected_<stage>), and in the outcomes metric, per error.
+        """
+
+        request = { 'body': body, 'address': address }
+
+        for stage, check in self.stages:
+            try:
+                rejection = check(request)
+            except PoolBusy as e:
+                self.logger.error(e)
+                rejection = falcon.HTTP_503, 'Server busy'
+            except Exception as e:
+                self.logger.error(e)
+                rejection = falcon.HTTP_400, 'Invalid request'
+
+            if rejection:
+                self.stats['rejected_' + stage] += 1
+                status, error = rejection
+                self._outcome(error)
+                return { 'status': status, 'error': error, 'retry_after': request.get('retry_after') }
 
         return {
             'status': falcon.HTTP_200,
-            'sha224' : sha224,
+            'sha224' : request['sha224'],
             'error': None,
         }
 
 
+    def _limit_address(self, address, n=1):
+        """Takes n tokens (one per challenge) from the bucket of address, returns the rejection if it was empty"""
+
+        wait = self.address_limiter.take(address, n) if self.address_limiter else 0
+
+        if wait:
+            self.stats['rejected_rate_get'] += 1
+            self._outcome('Too many requests')
+            return { 'status': falcon.HTTP_429, 'error': 'Too many requests', 'retry_after': wait }
+
+
+    def _outcome(self, outcome):
+        """Counts a request outcome (e.g. 'Expired response' as expired_response)"""
+
+        self.metrics.count(OUTCOMES, outcome=outcome.lower().replace(' ', '_'))
+
+
+    def _reject(self, resp, rejection):
+
+        resp.status = rejection['status']
+        resp.body = json.dumps({ 'error' : rejection['error'] })
+
+        if rejection.get('retry_after'):
+            resp.set_header('Retry-After', str(rejection['retry_after']))
+
+
+    def _is_revoked(self, current, sha224):
+        """True if the backend says sha224 is revoked, or the journal has its revoke pending"""
+
+        if current['status'] == 'revoked':
+            return True
+
+        return self.journal is not None and self.journal.is_revoking(sha224)
+
+
+    def _is_pending(self, sha224):
+        """True if the journal has a change for sha224 not yet applied to the backend"""
+
+        return self.journal is not None and self.journal.is_pending(sha224)
+
+
+    def _unconfirmed(self, current, address):
+        """True if current says that the record already points to address, but comes from a cache
+
+        (e.g. an entry of the Route53 index older than route53_index_staleness, that may have
+        missed a change made by another worker), so the write can not be skipped without
+        asking the backend again.
+        """
+
+        return current.get('cached') and current['status'] == 'registered' and current['address'] == address
+
+
+    def _needs_update(self, current, sha224, address):
+
+        if current['status'] == 'registered' and current['address'] == address and not self._is_pending(sha224):
+            self.stats['writes_avoided'] += 1
+            return False
+
+        self.stats['writes'] += 1
+        return True
+
+
+    def _challenge_body(self, address, n=1):
+        """The challenges for address, and the address itself (so clients can see when it changes)"""
+
+        with self.metrics.time(PHASE, phase='challenge'):
+            body = {
+                'challenge' : self.challenger.issue(address),
+                'address' : address,
+            }
+
+            if n > 1:
+                body['challenges'] = [ body['challenge'] ] + [ self.challenger.issue(address) for i in range(n - 1) ]
+
+        return body
+
+
+    def _challenges_requested(self, req):
+        """Number of challenges asked for with ?n= (1 to batch_max)"""
+
+        return min(max(req.get_param_as_int('n') or 1, 1), self.batch_max)
+
+
+    def _revoked_body(self, sha224):
+
+        self._outcome('revoked')
+
+        return {
+            'error': 'revoked public key',
+            'name': self.backend.name(sha224)
+        }
+
+
+    def _registered_body(self, sha224, address):
+
+        self._outcome('registered')
+
+        return {
+            'ip': address,
+            'name': self.backend.name(sha224)
+        }
+
+
+    def _revocation_body(self, sha224):
+
+        self._outcome('revocation')
+
+        return {
+            'message' : '{} has been revoked'.format(self.backend.name(sha224)),
+        }
+
+
+    def _error_body(self, e):
+
+        self.logger.error(e)
+        self._outcome('backend error')
+
+        body = {
+            'error' : 'An error has been ocurred',
+        }
+
+        # e.g. Route53 throttling us, or its circuit breaker open
+        if getattr(e, 'retry_after', None):
+            body['retry_after'] = e.retry_after
+
+        return body
+
+
+    def _backend_error(self, resp, e):
+
+        body = self._error_body(e)
+
+        resp.status = falcon.HTTP_503
+        resp.body = json.dumps(body)
+
+        if body.get('retry_after'):
+            resp.set_header('Retry-After', str(body['retry_after']))
+
+
     def on_get(self, req, resp):
         """Handles GET requests"""
 
-        token = '{}@{}@{}'.format(
-            req.headers.get('X-FORWARDED-FOR', req.remote_addr),
-            int(time()),
-            SHA224.new(Random.new().read(64)).hexdigest(),
-        )
+        address = self._address(req)
+        n = self._challenges_requested(req)
+        rejection = self._not_ready() or self._limit_address(address, n)
 
-        challenge = self.pub.encrypt(token.encode(), '0')[0]
-        challenge = base64.b64encode(challenge).decode()
+        if rejection:
+            self._reject(resp, rejection)
+            return
 
-        resp.body = json.dumps({
-            'challenge' : challenge,
-        })
+        resp.body = json.dumps(self._challenge_body(address, n))
 
 
     def on_post(self, req, resp):
         """Handles POST requests"""
 
-        validation = self._validate_response(req)
+        address = self._address(req)
+        validation = self._validate_response(self._read_body(req), address)
 
         if validation['status'] != falcon.HTTP_200:
-            resp.status = validation['status']
-            resp.body = json.dumps({ 'error' : validation['error'] })
+            self._reject(resp, validation)
             return
 
-        current = self.backend.check(validation['sha224'])
+        sha224 = validation['sha224']
 
-        if current['status'] == 'revoked':
+        try:
+            with self.metrics.time(PHASE, phase='backend_check'):
+                current = self.backend.check(sha224)
+                if self._unconfirmed(current, address):
+                    current = self.backend.confirm(sha224)
+        except Exception as e:
+            self._backend_error(resp, e)
+            return True
+
+        if self._is_revoked(current, sha224):
             resp.status = falcon.HTTP_200
-            resp.body = json.dumps({
-                'error': 'revoked public key',
-                'name': '{}.{}'.format(validation['sha224'], self.config['domain'])
-            })
+            resp.body = json.dumps(self._revoked_body(sha224))
             return True
 
         try:
-            self.backend.update(validation['sha224'], req.headers.get('X-FORWARDED-FOR', req.remote_addr))
+            if self._needs_update(current, sha224, address):
+                with self.metrics.time(PHASE, phase='backend_update'):
+                    if self.journal:
+                        self.journal.submit('update', sha224, address)
+                    else:
+                        self.backend.update(sha224, address)
             resp.status = falcon.HTTP_200
-            resp.body = json.dumps({
-                'ip': req.headers.get('X-FORWARDED-FOR', req.remote_addr),
-                'name': '{}.{}'.format(validation['sha224'], self.config['domain'])
-            })
+            resp.body = json.dumps(self._registered_body(sha224, address))
         except Exception as e:
-            self.logger.error(e)
-            resp.status = falcon.HTTP_503
-            resp.body = json.dumps({
-                'error' : 'An error has been ocurred',
-            })
+            self._backend_error(resp, e)
 
         return True
 
@@ -179,32 +701,392 @@ class AsyDNS():
     def on_delete(self, req, resp):
         """Handles DELETE requests"""
 
-        validation = self._validate_response(req)
+        validation = self._validate_response(self._read_body(req), self._address(req))
 
         if validation['status'] != falcon.HTTP_200:
-            resp.status = validation['status']
-            resp.body = json.dumps({ 'error' : validation['error'] })
+            self._reject(resp, validation)
             return
 
+        sha224 = validation['sha224']
+
         try:
-            self.backend.revoke(validation['sha224'])
+            with self.metrics.time(PHASE, phase='backend_revoke'):
+                if self.journal:
+                    self.journal.submit('revoke', sha224)
+                else:
+                    self.backend.revoke(sha224)
             resp.status = falcon.HTTP_200
-            resp.body = json.dumps({
-                'message' : '{}.{} has been revoked'.format(validation['sha224'], self.config['domain']),
-            })
+            resp.body = json.dumps(self._revocation_body(sha224))
         except Exception as e:
-            self.logger.error(e)
-            resp.status = falcon.HTTP_503
-            resp.body = json.dumps({
-                'error' : 'An error has been ocurred',
-            })
+            self._backend_error(resp, e)
 
         return True
 
 
-app = falcon.API()
-app.req_options.auto_parse_form_urlencoded = True
+    def _batch_entry(self, entry, address):
+        """Validates one entry of a batch, returns (result, update or None)"""
+
+        if not isinstance(entry, dict):
+            return { 'error': 'Invalid request' }, None
+
+        target = address
+
+        if self.batch_custom_address and entry.get('address'):
+            try:
+                target = str(ipaddress.ip_address(entry['address']))
+            except ValueError:
+                return { 'error': 'Invalid address' }, None
+
+        validation = self._validate_response(json.dumps(entry).encode(), address)
+
+        if validation['status'] != falcon.HTTP_200:
+            result = { 'error': validation['error'] }
+            if validation.get('retry_after'):
+                result['retry_after'] = validation['retry_after']
+            return result, None
+
+        sha224 = validation['sha224']
+
+        try:
+            with self.metrics.time(PHASE, phase='backend_check'):
+                current = self.backend.check(sha224)
+                if self._unconfirmed(current, target):
+                    current = self.backend.confirm(sha224)
+        except Exception as e:
+            return self._error_body(e), None
+
+        if self._is_revoked(current, sha224):
+            return self._revoked_body(sha224), None
+
+        update = (sha224, target) if self._needs_update(current, sha224, target) else None
+
+        return self._registered_body(sha224, target), update
+
+
+    def _batch(self, body, address):
+        """Validates a batch of registrations made from address and applies them
+
+        The entries are verified in parallel (in batch_executor, and in the crypto pool
+        if there is one) and all the resulting changes go to the backend together.
+        Returns (status, body), with one result per entry, in order.
+        """
+
+        rejection = self._not_ready()
+
+        if rejection:
+            return rejection['status'], { 'error': rejection['error'], 'retry_after': rejection['retry_after'] }
+
+        if len(body) > self.batch_max_body:
+            return falcon.HTTP_413, { 'error': 'Request too large' }
+
+        try:
+            entries = json.loads(body.decode('utf-8'))['entries']
+            if not isinstance(entries, list) or len(entries) > self.batch_max:
+                raise ValueError('Invalid batch')
+        except Exception as e:
+            self.logger.error(e)
+            return falcon.HTTP_400, { 'error': 'Invalid request' }
+
+        validated = list(self.batch_executor.map(lambda entry: self._batch_entry(entry, address), entries))
+
+        results = [ result for result, update in validated ]
+        updates = dict([ update for result, update in validated if update ])
+
+        try:
+            if updates:
+                with self.metrics.time(PHASE, phase='backend_update'):
+                    if self.journal:
+                        self.journal.submit_many('update', list(updates.items()))
+                    elif hasattr(self.backend, 'update_many'):
+                        self.backend.update_many(list(updates.items()))
+                    else:
+                        for sha224, target in updates.items():
+                            self.backend.update(sha224, target)
+        except Exception as e:
+            error = self._error_body(e)
+            results = [ error if update else result for result, update in validated ]
+
+        return falcon.HTTP_200, { 'results': results }
+
+
+class AsyDNSBatch():
+
+    def __init__(self, asydns):
+        self.asydns = asydns
+
+
+    def on_post(self, req, resp):
+        """Handles POST requests"""
+
+        asydns = self.asydns
+
+        body = req.bounded_stream.read(asydns.batch_max_body + 1)
+        resp.status, result = asydns._batch(body, asydns._address(req))
+        resp.body = json.dumps(result)
+
+
+class AsyDNSBatchAsync(AsyDNSBatch):
+
+    async def on_post(self, req, resp):
+        """Handles POST requests"""
+
+        asydns = self.asydns
+
+        body = await req.stream.read(asydns.batch_max_body + 1)
+        resp.status, result = await asyncio.get_event_loop().run_in_executor(None, asydns._batch, body, asydns._address(req))
+        resp.body = json.dumps(result)
+
+
+class AsyDNSAsync():
+
+    def __init__(self, asydns):
+        """ASGI version of the AsyDNS resource
+
+        Shares the state and the request logic of an AsyDNS instance. The crypto work
+        runs in an executor (or in the crypto pool) and the backend is used through
+        AsyncBackend, so the event loop keeps serving while they wait.
+        """
+
+        self.asydns = asydns
+        self.executor = ThreadPoolExecutor(max_workers=asydns.config.get('async_crypto_threads', os.cpu_count() or 1))
+
+
+    @property
+    def backend(self):
+
+        asydns = self.asydns
+
+        return asydns._per_process('async_backend', lambda: AsyncBackend(asydns.backend, asydns.config))
+
+
+    async def _run(self, fn, *args):
+
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+
+    async def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        asydns = self.asydns
+
+        address = asydns._address(req)
+        n = asydns._challenges_requested(req)
+        rejection = asydns._not_ready() or asydns._limit_address(address, n)
+
+        if rejection:
+            asydns._reject(resp, rejection)
+            return
+
+        resp.body = json.dumps(asydns._challenge_body(address, n))
+
+
+    async def on_post(self, req, resp):
+        """Handles POST requests"""
+
+        asydns = self.asydns
+
+        address = asydns._address(req)
+        validation = await self._run(asydns._validate_response, await req.stream.read(asydns.max_body + 1), address)
+
+        if validation['status'] != falcon.HTTP_200:
+            asydns._reject(resp, validation)
+            return
+
+        sha224 = validation['sha224']
+
+        try:
+            with asydns.metrics.time(PHASE, phase='backend_check'):
+                current = await self.backend.check(sha224)
+                if asydns._unconfirmed(current, address):
+                    current = await self.backend.confirm(sha224)
+        except Exception as e:
+            asydns._backend_error(resp, e)
+            return
+
+        if asydns._is_revoked(current, sha224):
+            resp.status = falcon.HTTP_200
+            resp.body = json.dumps(asydns._revoked_body(sha224))
+            return
+
+        try:
+            if asydns._needs_update(current, sha224, address):
+                with asydns.metrics.time(PHASE, phase='backend_update'):
+                    if asydns.journal:
+                        await self._run(asydns.journal.submit, 'update', sha224, address)
+                    else:
+                        await self.backend.update(sha224, address)
+            resp.status = falcon.HTTP_200
+            resp.body = json.dumps(asydns._registered_body(sha224, address))
+        except Exception as e:
+            asydns._backend_error(resp, e)
+
+
+    async def on_delete(self, req, resp):
+        """Handles DELETE requests"""
+
+        asydns = self.asydns
+
+        validation = await self._run(asydns._validate_response, await req.stream.read(asydns.max_body + 1), asydns._address(req))
+
+        if validation['status'] != falcon.HTTP_200:
+            asydns._reject(resp, validation)
+            return
+
+        sha224 = validation['sha224']
+
+        try:
+            with asydns.metrics.time(PHASE, phase='backend_revoke'):
+                if asydns.journal:
+                    await self._run(asydns.journal.submit, 'revoke', sha224)
+                else:
+                    await self.backend.revoke(sha224)
+            resp.status = falcon.HTTP_200
+            resp.body = json.dumps(asydns._revocation_body(sha224))
+        except Exception as e:
+            asydns._backend_error(resp, e)
+
+
+class AsyDNSStats():
+
+    def __init__(self, asydns):
+        self.asydns = asydns
+
+
+    def _stats(self):
+
+        stats = dict(self.asydns.stats)
+        stats['key_cache'] = self.asydns.keys.stats()
+
+        return stats
+
+
+    def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.body = json.dumps(self._stats())
+
+
+class AsyDNSStatsAsync(AsyDNSStats):
+
+    async def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.body = json.dumps(self._stats())
+
+
+class AsyDNSReady():
+
+    def __init__(self, asydns):
+        self.asydns = asydns
+
+
+    def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        ready, body = self.asydns._readiness()
+
+        resp.status = falcon.HTTP_200 if ready else falcon.HTTP_503
+        resp.body = json.dumps(body)
+
+
+class AsyDNSReadyAsync(AsyDNSReady):
+
+    async def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        ready, body = self.asydns._readiness()
+
+        resp.status = falcon.HTTP_200 if ready else falcon.HTTP_503
+        resp.body = json.dumps(body)
+
+
+class AsyDNSMetrics():
+
+    def __init__(self, asydns):
+        self.asydns = asydns
+
+
+    def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.body = self.asydns.metrics.render()
+
+
+class AsyDNSMetricsAsync(AsyDNSMetrics):
+
+    async def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.body = self.asydns.metrics.render()
+
+
+def create_app(asydns=None):
+    """WSGI app serving an AsyDNS instance (by default, one built from ~/.asydns)
+
+    e.g.: gunicorn --preload 'asydnsd:create_app()', to build it once in the master
+    """
+
+    if asydns is None:
+        asydns = AsyDNS()
+
+    middleware = [ MetricsMiddleware(asydns.metrics) ] if asydns.metrics.enabled else []
+
+    app = falcon.API(middleware=middleware)
+    app.req_options.auto_parse_form_urlencoded = True
+
+    app.add_route('/api', asydns)
+    app.add_route('/api/batch', AsyDNSBatch(asydns))
+    app.add_route('/stats', AsyDNSStats(asydns))
+    app.add_route('/ready', AsyDNSReady(asydns))
+
+    if asydns.metrics.enabled:
+        app.add_route('/metrics', AsyDNSMetrics(asydns))
+
+    return app
+
+
+def create_asgi_app(asydns=None):
+    """ASGI app serving an AsyDNS instance, like create_app (None if falcon is older than 3)"""
+
+    if not falcon_asgi:
+        return None
+
+    if asydns is None:
+        asydns = AsyDNS()
+
+    middleware = [ MetricsMiddleware(asydns.metrics) ] if asydns.metrics.enabled else []
+
+    asgi_app = falcon_asgi.App(middleware=middleware)
+    asgi_app.add_route('/api', AsyDNSAsync(asydns))
+    asgi_app.add_route('/api/batch', AsyDNSBatchAsync(asydns))
+    asgi_app.add_route('/stats', AsyDNSStatsAsync(asydns))
+    asgi_app.add_route('/ready', AsyDNSReadyAsync(asydns))
+
+    if asydns.metrics.enabled:
+        asgi_app.add_route('/metrics', AsyDNSMetricsAsync(asydns))
+
+    return asgi_app
+
+
+_instances = {}
+
+
+def __getattr__(name):
+    """Builds asydns, app and asgi_app (from ~/.asydns) the first time one is used
+
+    e.g.: gunicorn asydnsd:app, or uvicorn asydnsd:asgi_app (falcon >= 3). Importing the
+    module alone does not load the config, so the classes can be used on their own.
+    """
+
+    if name not in ['asydns', 'app', 'asgi_app']:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
 
-asydns = AsyDNS()
+    if not _instances:
+        asydns = AsyDNS()
+        _instances['asydns'] = asydns
+        _instances['app'] = create_app(asydns)
+        _instances['asgi_app'] = create_asgi_app(asydns)
 
-app.add_route('/api', asydns)
+    return _instances[name]
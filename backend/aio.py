@@ -0,0 +1,56 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncBackend():
+
+    def __init__(self, backend, config):
+        """ expone check/update/revoke de un backend como corrutinas
+
+            si el backend tiene check_async/update_async/revoke_async se usan esas,
+            si no, los metodos sincronicos corren en un pool de async_backend_threads threads
+
+            ningun backend tiene metodos *_async (no hay un cliente asincronico de Route53
+            entre las dependencias): los requests en curso esperan como corrutinas, pero
+            las llamadas al backend usan un thread cada una. Por defecto el pool tiene el
+            doble de threads que conexiones el cliente de Route53 (route53_max_connections),
+            porque con mas threads las llamadas solo esperarian una conexion o el rate limit
+        """
+
+        self.backend = backend
+
+        threads = config.get('async_backend_threads', 2 * int(config.get('route53_max_connections', 10)))
+
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+
+    async def _call(self, name, *args):
+
+        native = getattr(self.backend, name + '_async', None)
+
+        if native:
+            return await native(*args)
+
+        method = getattr(self.backend, name)
+
+        return await asyncio.get_event_loop().run_in_executor(self.executor, method, *args)
+
+
+    async def check(self, registry):
+        return await self._call('check', registry)
+
+
+    async def confirm(self, registry):
+        return await self._call('confirm', registry)
+
+
+    async def update(self, registry, ip):
+        return await self._call('update', registry, ip)
+
+
+    async def revoke(self, registry):
+        return await self._call('revoke', registry)
+
+
+    async def update_many(self, updates):
+        return await self._call('update_many', updates)
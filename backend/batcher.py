@@ -0,0 +1,226 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from time import sleep
+
+
+# limites de Route53 por ChangeBatch: 1000 ResourceRecord (los UPSERT cuentan doble)
+# y 32000 caracteres sumando todos los Value
+MAX_RECORDS = 1000
+MAX_CHARS = 32000
+
+RETRY_ERRORS = ['Throttling', 'PriorRequestNotComplete', 'ServiceUnavailable']
+
+
+def retryable(e):
+    """ indica si hay que reintentar mas tarde (throttling, API caida o circuit breaker abierto) """
+
+    if getattr(e, 'retry_after', None) is not None:
+        return True
+
+    return getattr(e, 'response', {}).get('Error', {}).get('Code') in RETRY_ERRORS
+
+
+def change_weight(change):
+    """ devuelve (records, caracteres) que ocupa un change dentro del ChangeBatch """
+
+    values = change['ResourceRecordSet'].get('ResourceRecords', [])
+    records = len(values) * (2 if change['Action'] == 'UPSERT' else 1)
+    chars = sum([ len(v['Value']) for v in values ]) * (2 if change['Action'] == 'UPSERT' else 1)
+
+    return records, chars
+
+
+def split_changes(changes, batch_size=MAX_RECORDS):
+    """ reparte los changes en listas que entran cada una en un ChangeBatch """
+
+    batch = []
+    records = chars = 0
+
+    for change in changes:
+        r, c = change_weight(change)
+        if batch and (records + r > batch_size or chars + c > MAX_CHARS):
+            yield batch
+            batch = []
+            records = chars = 0
+        records += r
+        chars += c
+        batch.append(change)
+
+    if batch:
+        yield batch
+
+
+class ChangeBatcher():
+
+    def __init__(self, client, zone_id, config):
+        """ junta los changes pendientes de una zona y los manda en ChangeBatches
+
+            los changes se deduplican por (Name, Type), gana el ultimo. Se envian cada
+            route53_flush_interval milisegundos o apenas se llena un batch
+            (route53_batch_size changes, respetando los limites de Route53)
+        """
+
+        self.client = client
+        self.zone_id = zone_id
+        self.config = config
+
+        self.logger = logging.getLogger('asydnsd')
+
+        self.interval = self.config.get('route53_flush_interval', 200) / 1000
+        self.batch_size = min(self.config.get('route53_batch_size', MAX_RECORDS), MAX_RECORDS)
+
+        self.pending = OrderedDict()
+        self.pending_records = 0
+        self.cond = Condition()
+        self.flush_lock = Lock()
+
+        Thread(target=self._flush_loop, daemon=True).start()
+
+
+    def submit(self, change):
+        """ encola un change y devuelve un Future que se resuelve con el ChangeInfo de Route53 """
+
+        future = Future()
+        key = (change['ResourceRecordSet']['Name'].rstrip('.'), change['ResourceRecordSet']['Type'])
+
+        with self.cond:
+            previous = self.pending.get(key)
+
+        # un DELETE tiene que llevar el valor actual del registro, que no se conoce si hay
+        # un UPSERT sin enviar, asi que primero se envia lo pendiente
+        if previous and change['Action'] == 'DELETE':
+            self.flush()
+            previous = None
+
+        with self.cond:
+            previous = self.pending.pop(key, None)
+            futures = [future]
+            if previous:
+                futures = previous[1] + futures
+                self.pending_records -= change_weight(previous[0])[0]
+            self.pending[key] = (change, futures)
+            self.pending_records += change_weight(change)[0]
+            if self.pending_records >= self.batch_size:
+                self.cond.notify()
+
+        return future
+
+
+    def _take(self):
+        """ saca de la cola los changes que entran en un ChangeBatch """
+
+        batch = []
+        records = chars = 0
+
+        with self.cond:
+            while self.pending:
+                key, (change, futures) = next(iter(self.pending.items()))
+                r, c = change_weight(change)
+                if batch and (records + r > self.batch_size or chars + c > MAX_CHARS):
+                    break
+                self.pending.popitem(last=False)
+                self.pending_records -= r
+                records += r
+                chars += c
+                batch.append((key, change, futures))
+
+        return batch
+
+
+    def _requeue(self, batch):
+        """ devuelve un batch a la cola sin pisar changes mas nuevos del mismo registro """
+
+        with self.cond:
+            for key, change, futures in reversed(batch):
+                if key in self.pending:
+                    newer, newer_futures = self.pending[key]
+                    self.pending[key] = (newer, futures + newer_futures)
+                else:
+                    self.pending[key] = (change, futures)
+                    self.pending.move_to_end(key, last=False)
+                    self.pending_records += change_weight(change)[0]
+
+
+    def _send(self, changes):
+
+        response = self.client.change_resource_record_sets(
+            HostedZoneId=self.zone_id,
+            ChangeBatch={ 'Changes': changes },
+        )
+
+        return response['ChangeInfo']
+
+
+    def flush(self):
+        """ envia todo lo pendiente; devuelve False si Route53 pidio esperar (throttling) """
+
+        with self.flush_lock:
+
+            while True:
+                batch = self._take()
+
+                if not batch:
+                    return True
+
+                try:
+                    info = self._send([ change for key, change, futures in batch ])
+                except Exception as e:
+                    if retryable(e):
+                        self.logger.error(e)
+                        self._requeue(batch)
+                        return False
+                    if len(batch) > 1:
+                        # el ChangeBatch es atomico: un change invalido hace fallar a todos
+                        if not self._send_one_by_one(batch):
+                            return False
+                        continue
+                    for f in batch[0][2]:
+                        f.set_exception(e)
+                    continue
+
+                for key, change, futures in batch:
+                    for f in futures:
+                        f.set_result(info)
+
+
+    def _send_one_by_one(self, batch):
+
+        for i, (key, change, futures) in enumerate(batch):
+            try:
+                info = self._send([change])
+            except Exception as e:
+                self.logger.error(e)
+                if retryable(e):
+                    self._requeue(batch[i:])
+                    return False
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            for f in futures:
+                f.set_result(info)
+
+        return True
+
+
+    def _flush_loop(self):
+
+        backoff = self.interval
+
+        while True:
+
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending_records >= self.batch_size, timeout=self.interval)
+
+            try:
+                ok = self.flush()
+            except Exception as e:
+                self.logger.error(e)
+                ok = False
+
+            if ok:
+                backoff = self.interval
+            else:
+                backoff = min(max(backoff * 2, 1), 30)
+                sleep(backoff)
@@ -0,0 +1,91 @@
+import logging
+import os
+import pwd
+from pathlib import Path
+from time import time
+
+from backend.store import RecordStore
+
+
+def local_dir(config, user=None):
+    """ directorio de datos del backend Local (config local_dir, o ~/.asydns/local) """
+
+    if config.get('local_dir'):
+        return Path(config['local_dir'])
+
+    if user:
+        home = Path(pwd.getpwnam(user).pw_dir)
+    else:
+        home = Path(pwd.getpwuid(os.getuid()).pw_dir)
+
+    return home / '.asydns' / 'local'
+
+
+class LocalBackend():
+
+    def __init__(self, config):
+        """ backend que guarda los registros localmente (ver backend.store), para
+            servirlos con asydns-dnsd.py en lugar de Route53
+        """
+
+        self.config = config
+
+        self.logger = logging.getLogger('asydnsd')
+
+        self.store = RecordStore(local_dir(self.config))
+
+
+    def name(self, registry):
+        """ nombre DNS del registro """
+
+        return registry + '.' + self.config['domain']
+
+
+    def revoke(self, registry):
+        """ marca el registro como revocado y elimina su direccion """
+
+        fqdn = self.name(registry)
+
+        self.store.revoke(registry, int(time()))
+
+        return { 'status' : 'revoked', 'name' : fqdn }
+
+
+    def update(self, registry, ip):
+        """ actualiza la direccion del registro {hash}.domain """
+
+        self.store.set(registry, ip, int(time()))
+
+
+    def update_many(self, updates):
+        """ actualiza varios registros [(hash, ip), ...] """
+
+        now = int(time())
+
+        for registry, ip in updates:
+            self.store.set(registry, ip, now)
+
+
+    def check(self, registry):
+        """ indica si un registro esta revocado y, si no lo esta, cual es la IP actual """
+
+        fqdn = self.name(registry)
+
+        current = self.store.get(registry)
+
+        if not current:
+            return { 'status' : 'non-registered', 'name' : fqdn }
+
+        address, updated, revoked = current
+
+        if revoked:
+            return { 'status' : 'revoked', 'name' : fqdn }
+
+        return { 'status' : 'registered' , 'name' : fqdn, 'address' : address }
+
+
+    def dump(self):
+        """ recorre los registros y las revocaciones: (registro, revocado, ip o None) """
+
+        for registry, address, updated, revoked in self.store.items():
+            yield registry, revoked, None if revoked else address
@@ -0,0 +1,196 @@
+import bisect
+import fcntl
+import logging
+import os
+import pwd
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import time
+
+
+DIGEST_SIZE = 28
+
+
+def revocation_file(config):
+    """ archivo del indice de revocaciones (config revocation_file, o ~/.asydns/revoked.bin) """
+
+    if config.get('revocation_file'):
+        return Path(config['revocation_file'])
+
+    return Path(pwd.getpwuid(os.getuid()).pw_dir) / '.asydns' / 'revoked.bin'
+
+
+class RevocationIndex():
+
+    def __init__(self, config, path):
+        """ conjunto de hashes revocados: filtro de Bloom + lista ordenada de digests binarios
+
+            se persiste en path como digests de 28 bytes, append-only. Cada proceso lo carga
+            al iniciar y lee lo que agregan los demas (como mucho cada
+            revocation_reload_interval segundos).
+
+            Como el digest ya es un hash uniforme, las k posiciones del filtro son
+            simplemente k fragmentos de 4 bytes del digest.
+        """
+
+        self.config = config
+        self.path = path
+
+        self.logger = logging.getLogger('asydnsd')
+
+        self.bits = int(self.config.get('revocation_bloom_bits', 2 ** 23))
+        self.hashes = min(int(self.config.get('revocation_bloom_hashes', 7)), DIGEST_SIZE // 4)
+        self.reload_interval = self.config.get('revocation_reload_interval', 1)
+
+        self.bloom = bytearray((self.bits + 7) // 8)
+        self.digests = []
+        self.offset = 0
+        self.checked = 0
+
+        self.lock = Lock()
+
+        self.ready_path = self.path.with_suffix('.ready')
+        self.is_ready = False
+        self.ready_checked = 0
+
+        self.path.touch()
+        self._reload()
+
+
+    @property
+    def ready(self):
+        """ False mientras no se importaron las revocaciones previas (registros r-)
+
+            (lo marca otro proceso, asi que se mira el archivo como mucho cada
+            revocation_reload_interval segundos, y ya no una vez que esta listo)
+        """
+
+        if not self.is_ready and time() - self.ready_checked > self.reload_interval:
+            return self.imported()
+
+        return self.is_ready
+
+
+    def imported(self):
+        """ como ready, pero mira el archivo ahora """
+
+        self.ready_checked = time()
+        self.is_ready = self.ready_path.is_file()
+
+        return self.is_ready
+
+
+    def set_ready(self):
+
+        self.ready_path.touch()
+        self.is_ready = True
+
+
+    @contextmanager
+    def import_lock(self):
+        """ lock entre procesos, para que un solo worker importe las revocaciones previas """
+
+        with self.path.with_suffix('.lock').open('a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                # explicitamente, por si un proceso hijo tiene una copia del archivo
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def _positions(self, digest):
+
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[i * 4:i * 4 + 4], 'little') % self.bits
+
+
+    def _insert(self, digest):
+
+        i = bisect.bisect_left(self.digests, digest)
+
+        if i < len(self.digests) and self.digests[i] == digest:
+            return False
+
+        self.digests.insert(i, digest)
+
+        for p in self._positions(digest):
+            self.bloom[p // 8] |= 1 << (p % 8)
+
+        return True
+
+
+    def _reload(self):
+        """ agrega los digests que se escribieron desde la ultima lectura """
+
+        with self.lock:
+
+            with self.path.open('rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+
+            # un append cortado por un crash deja un digest incompleto al final
+            usable = len(data) - len(data) % DIGEST_SIZE
+
+            for i in range(0, usable, DIGEST_SIZE):
+                self._insert(data[i:i + DIGEST_SIZE])
+
+            self.offset += usable
+            self.checked = time()
+
+
+    def __contains__(self, registry):
+
+        if time() - self.checked > self.reload_interval:
+            self._reload()
+
+        digest = bytes.fromhex(registry)
+
+        for p in self._positions(digest):
+            if not self.bloom[p // 8] & (1 << (p % 8)):
+                return False
+
+        i = bisect.bisect_left(self.digests, digest)
+
+        return i < len(self.digests) and self.digests[i] == digest
+
+
+    def add(self, registry):
+        """ agrega registry al conjunto, persistiendolo antes de volver """
+
+        digest = bytes.fromhex(registry)
+
+        if len(digest) != DIGEST_SIZE:
+            # un digest de otro largo corre a todos los que se agreguen despues
+            raise ValueError('Invalid registry ({})'.format(registry))
+
+        if registry in self:
+            return
+
+        fd = os.open(str(self.path), os.O_WRONLY | os.O_APPEND)
+
+        try:
+            os.write(fd, digest)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self._reload()
+
+
+    def __iter__(self):
+        """ recorre los hashes revocados (hex) """
+
+        self._reload()
+
+        with self.lock:
+            digests = list(self.digests)
+
+        for digest in digests:
+            yield digest.hex()
+
+
+    def __len__(self):
+
+        return len(self.digests)
@@ -1,87 +1,219 @@
 
-import boto3
+import logging
+import re
+from threading import Lock, Thread
+from time import sleep, time
+
+from backend.batcher import ChangeBatcher, split_changes
+from backend.revocation import RevocationIndex, revocation_file
+from backend.route53_client import Route53Client
+from metrics import InstrumentedClient
+
+
+REGISTRY = re.compile('^[0-9a-f]{56}$')
+
 
 class Route53Backend():
 
-    def __init__(self, config):
+    def __init__(self, config, client=None):
         """ inicializa la API de registry
             se le pasa la config, para que pueda tomar credenciales, dominio, etc
+            (y opcionalmente el cliente de Route53 a usar, por ejemplo el falso de bench/)
         """
 
         self.config = config
 
-        required = ['aws_id', 'aws_secret', 'route53_zone_id']
+        required = ['route53_zone_id'] + ([] if client else ['aws_id', 'aws_secret'])
         missing = [ m for m in required if m not in self.config.keys() ]
 
         if missing:
             raise Exception('InvalidConfig', 'Missing required values {}'.format(','.join(missing)))
 
-        self.client = boto3.client('route53',
-            aws_access_key_id=self.config['aws_id'],
-            aws_secret_access_key=self.config['aws_secret']
-        )
+        self.logger = logging.getLogger('asydnsd')
+
+        self.client = Route53Client(self.config, client)
+        self.breaker = self.client.breaker
+
+        # la hosted zone se valida en segundo plano, para no demorar el arranque
+        self.hosted_zone = None
+        self.zone_error = None
+
+        Thread(target=self._load_zone, daemon=True).start()
+
+        self.suffix = '.' + self.config['domain'].rstrip('.') + '.'
+
+        # registro -> (ip, cuando lo escribio este proceso o aparecio en el listado)
+        self.index = {}
+        self.revoked = set()
+        self.touched = set()
+        self.index_lock = Lock()
+        self.index_ready = False
+        self.index_synced = 0
+
+        self.index_enabled = self.config.get('route53_index', False)
+        self.index_staleness = self.config.get('route53_index_staleness', 3600)
+        self.index_miss_fallback = self.config.get('route53_index_miss_fallback', True)
+        self.resync_interval = self.config.get('route53_resync_interval', 1)
+
+        self.batcher = None
+        self.wait = self.config.get('route53_wait', 'submitted')
+
+        if self.wait not in ['queued', 'submitted', 'insync']:
+            raise Exception('InvalidConfig', 'Invalid route53_wait ({}). Options: queued,submitted,insync'.format(self.wait))
+
+        if self.config.get('route53_batching', False):
+            self.batcher = ChangeBatcher(self.client, self.config['route53_zone_id'], self.config)
+
+        # con el indice de revocaciones, revocar ya no crea registros r- en la zona
+        self.revocations = None
+        self.revocation_records = self.config.get('route53_revocation_records', True)
+
+        if self.config.get('route53_revocation_index', False):
+            self.revocations = RevocationIndex(self.config, revocation_file(self.config))
+            self.revocation_records = self.config.get('route53_revocation_records', False)
+            if not self.revocations.ready:
+                Thread(target=self._import_revocations, daemon=True).start()
+
+        # al final, porque el sync tambien agrega al indice de revocaciones
+        if self.index_enabled:
+            Thread(target=self._sync_loop, daemon=True).start()
+
+
+    def _load_zone(self):
+        """ carga la hosted zone y verifica que sea la del dominio de la config
+            (si no lo es, check y los cambios fallan con el error)
+        """
+
+        while True:
+            try:
+                response = self.client.get_hosted_zone(Id=self.config['route53_zone_id'])
+                break
+            except Exception as e:
+                self.logger.error(e)
+                sleep(10)
 
-        response = self.client.get_hosted_zone(Id=self.config['route53_zone_id'])
         self.hosted_zone = response['HostedZone']
 
         if self.hosted_zone['Name'] != self.config['domain']:
-            raise Exception('InvalidConfig', 'Config domain ({}) and hosted zone name ({}) are diferent'.format(
+            self.zone_error = Exception('InvalidConfig', 'Config domain ({}) and hosted zone name ({}) are diferent'.format(
                 self.hosted_zone['Name'],
                 self.config['domain']
             ))
+            self.logger.error(self.zone_error)
+
+
+    def ready(self):
+        """ indica si ya se valido la hosted zone (y si es la del dominio) """
+
+        return self.hosted_zone is not None and self.zone_error is None
+
+
+    def _check_zone(self):
+
+        if self.zone_error:
+            raise self.zone_error
+
+
+    def set_metrics(self, metrics):
+        """ mide cada llamada a la API de Route53 (tambien las del batcher) """
+
+        self.client = InstrumentedClient(self.client, metrics, 'route53')
+
+        if self.batcher:
+            self.batcher.client = self.client
+
+
+    def _record(self, action, name, ip):
+
+        return {
+            'Action': action,
+            'ResourceRecordSet': {
+                'Name': name,
+                'Type': 'A',
+                'TTL': 300,
+                'ResourceRecords': [
+                    {
+                        'Value': ip,
+                    },
+                ],
+            }
+        }
+
+
+    def _change(self, changes):
+        """ aplica los changes, directo o a traves del batcher
+
+            con el batcher, route53_wait define cuando se vuelve: queued (apenas se encola),
+            submitted (cuando Route53 acepto el ChangeBatch) o insync (cuando se propago)
+
+            mientras el circuit breaker esta abierto, con el batcher los changes quedan en
+            su cola (se envian cuando Route53 vuelve) y se vuelve sin esperar
+        """
+
+        self._check_zone()
+
+        if self.batcher and self.breaker.is_open():
+            for c in changes:
+                self.batcher.submit(c)
+            return
+
+        if not self.batcher:
+            response = self.client.change_resource_record_sets(
+                HostedZoneId=self.config['route53_zone_id'],
+                ChangeBatch={ 'Changes': changes },
+            )
+            infos = [ response['ChangeInfo'] ]
+        else:
+            futures = [ self.batcher.submit(c) for c in changes ]
+            if self.wait == 'queued':
+                return
+            infos = [ f.result() for f in futures ]
+
+        if self.wait == 'insync':
+            waiter = self.client.get_waiter('resource_record_sets_changed')
+            for change_id in set([ i['Id'] for i in infos ]):
+                waiter.wait(Id=change_id, WaiterConfig={ 'Delay': 2, 'MaxAttempts': 60 })
+
+
+    def name(self, registry):
+        """ nombre DNS del registro """
+
+        return registry + '.' + self.config['domain']
 
 
     def revoke(self, registry):
         """ crea el registro r-{hash}.{domain} y elimina el registro r-{hash}.domain """
 
-        fqdn = registry + '.' + self.config['domain']
-        current = self.check(registry)
+        fqdn = self.name(registry)
+
+        if self.revocations is not None and registry in self.revocations:
+            return { 'status' : 'revoked', 'name' : fqdn }
+
+        # por la API y no por el indice: puede tener una ip vieja (si el registro lo
+        # actualizo otro worker), y Route53 rechaza el DELETE con otro valor, y con el
+        # todo el ChangeBatch
+        current = self.confirm(registry)
 
         if current['status'] == 'revoked':
             return { 'status' : 'revoked', 'name' : fqdn }
 
+        changes = []
+
         if current['status'] == 'registered':
-            response = self.client.change_resource_record_sets(
-                HostedZoneId=self.config['route53_zone_id'],
-                ChangeBatch={
-                    'Changes': [
-                        {
-                            'Action': 'DELETE',
-                            'ResourceRecordSet': {
-                                'Name': registry + '.' + self.config['domain'],
-                                'Type': 'A',
-                                'TTL': 300,
-                                'ResourceRecords': [
-                                    {
-                                        'Value': current['address'],
-                                    },
-                                ],
-                            }
-                        },
-                    ]
-                }
-            )
+            changes.append(self._record('DELETE', fqdn, current['address']))
 
-        response = self.client.change_resource_record_sets(
-            HostedZoneId=self.config['route53_zone_id'],
-            ChangeBatch={
-                'Changes': [
-                    {
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': 'r-' + registry + '.' + self.config['domain'],
-                            'Type': 'A',
-                            'TTL': 300,
-                            'ResourceRecords': [
-                                {
-                                    'Value': '127.0.0.1',
-                                },
-                            ],
-                        }
-                    },
-                ]
-            }
-        )
+        if self.revocation_records:
+            changes.append(self._record('UPSERT', 'r-' + fqdn, '127.0.0.1'))
+
+        if changes:
+            self._change(changes)
+
+        # recien despues de borrar el registro: si Route53 falla, el reintento tiene que
+        # volver a ver el registro (y no una revocacion que lo deja en la zona)
+        if self.revocations is not None:
+            self.revocations.add(registry)
+
+        self._index_set(registry, revoked=True)
 
         return { 'status' : 'revoked', 'name' : fqdn }
 
@@ -89,42 +221,96 @@ class Route53Backend():
     def update(self, registry, ip):
         """ usa registry_check para si no esta revocado, si no lo esta, actualiza el registro {hash}.domain """
 
-        response = self.client.change_resource_record_sets(
-            HostedZoneId=self.config['route53_zone_id'],
-            ChangeBatch={
-                'Changes': [
-                    {
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': registry + '.' + self.config['domain'],
-                            'Type': 'A',
-                            'TTL': 300,
-                            'ResourceRecords': [
-                                {
-                                    'Value': ip,
-                                },
-                            ],
-                        }
-                    },
-                ]
-            }
-        )
+        self._change([ self._record('UPSERT', self.name(registry), ip) ])
+
+        self._index_set(registry, address=ip)
+
+
+    def update_many(self, updates):
+        """ actualiza varios registros [(hash, ip), ...] con la menor cantidad de ChangeBatch """
+
+        changes = [ self._record('UPSERT', self.name(registry), ip) for registry, ip in updates ]
+
+        if self.batcher:
+            # el batcher ya los junta con los demas changes pendientes
+            self._change(changes)
+        else:
+            for batch in split_changes(changes):
+                self._change(batch)
+
+        for registry, ip in updates:
+            self._index_set(registry, address=ip)
+
+
+    def delete(self, registry, address, revoked=False):
+        """ elimina el registro (o su r-) de la zona sin revocarlo, por ejemplo para moverlo a otro shard """
+
+        fqdn = self.name(registry)
+
+        self._change([ self._record('DELETE', 'r-' + fqdn if revoked else fqdn, address) ])
+
+        if self.index_enabled:
+            with self.index_lock:
+                self.touched.add(registry)
+                self.index.pop(registry, None)
+                self.revoked.discard(registry)
 
 
     def check(self, registry):
-        """ indica si un registro esta revocado y, si no lo esta, cual es la IP actual """
+        """ indica si un registro esta revocado y, si no lo esta, cual es la IP actual
+
+            las respuestas del indice con cached vienen de entradas de mas de
+            route53_index_staleness segundos (cada worker tiene su propio indice, y los
+            cambios de los demas recien los ve en el listado siguiente); antes de evitar una
+            escritura porque la ip no cambio hay que confirmarlas con confirm()
+        """
+
+        self._check_zone()
 
-        fqdn = registry + '.' + self.config['domain']
+        # mientras se importan los registros r- el indice de revocaciones ya tiene las
+        # revocaciones nuevas (que no crean r-), solo un fallo necesita consultar la API
+        if self.revocations is not None and registry in self.revocations:
+            return { 'status' : 'revoked', 'name' : self.name(registry) }
+
+        if self.index_enabled:
+            current = self._check_index(registry)
+            if current:
+                return current
+
+        return self.confirm(registry)
+
+
+    def confirm(self, registry):
+        """ como check, pero siempre consulta la API (y actualiza el indice con la respuesta) """
+
+        self._check_zone()
+
+        revocations_known = self.revocations is not None and self.revocations.ready
+
+        current = self._check_api(registry, not revocations_known)
+
+        self._index_set(registry, current.get('address'), current['status'] == 'revoked')
+
+        return current
+
+
+    def _check_api(self, registry, check_revoked=True):
+        """ consulta el estado de un registro con test_dns_answer
+            (dos llamadas, o una si no hace falta buscar el registro r-)
+        """
+
+        fqdn = self.name(registry)
         rfqdn = 'r-' + fqdn
 
-        response_rfqdn = self.client.test_dns_answer(
-            HostedZoneId=self.config['route53_zone_id'],
-            RecordName=rfqdn,
-            RecordType='A',
-        )
+        if check_revoked:
+            response_rfqdn = self.client.test_dns_answer(
+                HostedZoneId=self.config['route53_zone_id'],
+                RecordName=rfqdn,
+                RecordType='A',
+            )
 
-        if response_rfqdn['RecordData']:
-            return { 'status' : 'revoked', 'name' : fqdn }
+            if response_rfqdn['RecordData']:
+                return { 'status' : 'revoked', 'name' : fqdn }
 
         response_fqdn = self.client.test_dns_answer(
             HostedZoneId=self.config['route53_zone_id'],
@@ -138,16 +324,239 @@ class Route53Backend():
             return { 'status' : 'non-registered', 'name' : fqdn }
 
 
+    def _check_index(self, registry):
+        """ responde desde el indice en memoria, o devuelve None si hay que consultar la API
+            (indice todavia no cargado, o registro ausente de un indice mas viejo que
+            route53_index_staleness)
+
+            una entrada que este proceso escribio o vio en el listado hace menos de
+            route53_index_staleness segundos se usa tal cual; las mas viejas salen con cached
+        """
+
+        if not self.index_ready:
+            return None
+
+        fqdn = self.name(registry)
+
+        with self.index_lock:
+            if registry in self.revoked:
+                return { 'status' : 'revoked', 'name' : fqdn }
+
+            address, seen = self.index.get(registry, (None, 0))
+
+        now = time()
+
+        if address:
+            current = { 'status' : 'registered' , 'name' : fqdn, 'address' : address }
+            if now - seen > self.index_staleness:
+                current['cached'] = True
+            return current
+
+        if self.index_miss_fallback or now - self.index_synced > self.index_staleness:
+            return None
+
+        return { 'status' : 'non-registered', 'name' : fqdn }
+
+
+    def _index_set(self, registry, address=None, revoked=False):
+
+        if not self.index_enabled:
+            return
+
+        with self.index_lock:
+            self.touched.add(registry)
+            if revoked:
+                self.revoked.add(registry)
+                self.index.pop(registry, None)
+            elif address:
+                self.index[registry] = (address, time())
+            else:
+                self.index.pop(registry, None)
+
+
+    def _parse_rrset(self, rrset):
+        """ devuelve (registro, revocado, ip) para un rrset de la zona, o None si no es de asydns """
+
+        name = rrset['Name']
+
+        if rrset['Type'] != 'A' or not name.endswith(self.suffix) or not rrset.get('ResourceRecords'):
+            return None
+
+        label = name[:-len(self.suffix)]
+
+        if '.' in label:
+            # nombres de subdominios delegados (por ejemplo, otros shards)
+            return None
+
+        address = rrset['ResourceRecords'][0]['Value']
+
+        revoked = label.startswith('r-')
+
+        if revoked:
+            label = label[2:]
+
+        if not REGISTRY.match(label):
+            # otros nombres de la zona (www, etc)
+            return None
+
+        return label, revoked, address
+
+
+    def records(self):
+        """ recorre todos los registros de la zona: (registro, revocado, ip) """
+
+        kwargs = { 'HostedZoneId' : self.config['route53_zone_id'] }
+
+        while True:
+
+            # pagina a mano (no con get_paginator), para pasar por el limite de llamadas
+            response = self.client.list_resource_record_sets(**kwargs)
+
+            for rrset in response['ResourceRecordSets']:
+                parsed = self._parse_rrset(rrset)
+                if parsed:
+                    yield parsed
+
+            if not response['IsTruncated']:
+                return
+
+            kwargs['StartRecordName'] = response['NextRecordName']
+            kwargs['StartRecordType'] = response['NextRecordType']
+
+
+    def dump(self):
+        """ recorre los registros y las revocaciones: (registro, revocado, ip o None)
+
+            con el indice de revocaciones, las revocaciones salen del indice (que tambien
+            tiene las que no tienen registro r- en la zona) y los r- que ya estan en el
+            indice se saltean, para no repetirlas
+        """
+
+        indexed = self.revocations is not None and self.revocations.ready
+
+        for registry, revoked, address in self.records():
+            if revoked and indexed and registry in self.revocations:
+                continue
+            yield registry, revoked, None if revoked else address
+
+        if indexed:
+            for registry in self.revocations:
+                yield registry, True, None
+
+
+    def _import_revocations(self):
+        """ carga en el indice de revocaciones los registros r- que ya existen en la zona
+
+            lo hace un solo proceso (los demas esperan el lock y ven que ya esta listo)
+        """
+
+        with self.revocations.import_lock():
+
+            if self.revocations.imported():
+                return
+
+            while True:
+                try:
+                    for registry, revoked, address in self.records():
+                        if revoked:
+                            self.revocations.add(registry)
+                    break
+                except Exception as e:
+                    self.logger.error(e)
+                    sleep(10)
+
+            self.revocations.set_ready()
+
+        self.logger.info('route53: {} revocations imported'.format(len(self.revocations)))
+
+
+    def _sync_loop(self):
+        """ recorre la zona completa con list_resource_record_sets, una pagina por vez
+
+            la primera pasada (bootstrap) se hace sin pausas, las siguientes esperan
+            route53_resync_interval segundos entre paginas. Al terminar cada pasada se
+            eliminan del indice los registros que ya no estan en la zona.
+        """
+
+        while True:
+
+            started = time()
+            seen = set()
+
+            with self.index_lock:
+                self.touched = set()
+
+            kwargs = { 'HostedZoneId' : self.config['route53_zone_id'] }
+
+            while True:
+
+                try:
+                    listed = time()
+                    response = self.client.list_resource_record_sets(**kwargs)
+                except Exception as e:
+                    self.logger.error(e)
+                    sleep(max(self.resync_interval, 1))
+                    continue
+
+                with self.index_lock:
+                    for rrset in response['ResourceRecordSets']:
+                        parsed = self._parse_rrset(rrset)
+                        if not parsed:
+                            continue
+                        registry, revoked, address = parsed
+                        seen.add(registry)
+                        if registry in self.touched:
+                            continue
+                        if revoked:
+                            self.revoked.add(registry)
+                            self.index.pop(registry, None)
+                            if self.revocations is not None:
+                                self.revocations.add(registry)
+                        elif registry not in self.revoked:
+                            self.index[registry] = (address, listed)
+
+                if not response['IsTruncated']:
+                    break
+
+                kwargs['StartRecordName'] = response['NextRecordName']
+                kwargs['StartRecordType'] = response['NextRecordType']
+
+                if self.index_ready:
+                    sleep(self.resync_interval)
+
+            with self.index_lock:
+                keep = seen | self.touched
+                self.index = { k:v for k,v in self.index.items() if k in keep }
+                self.revoked = { r for r in self.revoked if r in keep }
+
+            self.index_synced = started
+            self.index_ready = True
+
+            sleep(self.resync_interval)
+
+
 if __name__ == '__main__':
 
+    import hashlib
     import json
-    with open('/home/f/.asydns/config.json') as config_file:
+    import os
+    import pwd
+    import sys
+    from pathlib import Path
+
+    # python3 -m backend.route53 [config.json], por defecto ~/.asydns/config.json
+    if len(sys.argv) > 1:
+        config_path = Path(sys.argv[1])
+    else:
+        config_path = Path(pwd.getpwuid(os.getuid()).pw_dir) / '.asydns' / 'config.json'
+
+    with config_path.open() as config_file:
         backend = Route53Backend(json.load(config_file))
 
     from time import sleep
 
     print('query')
-    tocheck = 'abcdefgh'
+    tocheck = hashlib.sha224(b'asydns').hexdigest()
     print(backend.check(tocheck))
 
     print('update to 4.4.4.')
@@ -0,0 +1,247 @@
+import math
+from functools import partial
+from threading import Lock
+from time import sleep, time
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from backend.batcher import RETRY_ERRORS
+from ratelimit import rate_limiter
+
+
+class Unavailable(Exception):
+
+    def __init__(self, message, retry_after):
+        """ Route53 no se puede usar ahora; retry_after: segundos hasta volver a intentar """
+
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+class Throttled(Unavailable):
+    pass
+
+
+def client_config(config):
+    """ Config de botocore: pool de conexiones keep-alive, timeouts y reintentos """
+
+    kwargs = {
+        'max_pool_connections': int(config.get('route53_max_connections', 10)),
+        'connect_timeout': config.get('route53_connect_timeout', 5),
+        'read_timeout': config.get('route53_read_timeout', 10),
+        'retries': {
+            'mode': config.get('route53_retry_mode', 'standard'),
+            'max_attempts': int(config.get('route53_max_attempts', 3)),
+        },
+        'tcp_keepalive': True,
+    }
+
+    try:
+        return Config(**kwargs)
+    except TypeError:
+        # botocore < 1.27 no tiene tcp_keepalive
+        kwargs.pop('tcp_keepalive')
+        return Config(**kwargs)
+
+
+def unhealthy(e):
+    """ indica si el error es de la API (throttling, 5xx, red) y no del pedido """
+
+    if isinstance(e, BotoCoreError):
+        return True
+
+    if isinstance(e, ClientError):
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return e.response.get('Error', {}).get('Code') in RETRY_ERRORS or status >= 500
+
+    return False
+
+
+_limiters = {}
+_limiters_lock = Lock()
+
+
+def account_limiter(config, rate, burst):
+    """ limiter de llamadas a Route53 compartido por todas las zonas del proceso (y por todos
+        los workers con ratelimit_mode shared), ya que la cuota de Route53 es por cuenta
+    """
+
+    key = (config.get('ratelimit_mode', 'local'), rate, burst)
+
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = rate_limiter(config, 'route53', rate, burst)
+        return _limiters[key]
+
+
+class CircuitBreaker():
+
+    def __init__(self, failures, reset):
+        """ se abre despues de failures errores seguidos de la API, y mientras esta abierto
+            las llamadas fallan en el momento. Pasados reset segundos deja pasar una llamada
+            de prueba: si anda se cierra, si no, se vuelve a abrir
+        """
+
+        self.failures = failures
+        self.reset = reset
+
+        self.count = 0
+        self.opened = 0
+        self.probing = False
+
+        self.lock = Lock()
+
+
+    def is_open(self):
+
+        return self.count >= self.failures and (time() < self.opened + self.reset or self.probing)
+
+
+    def retry_after(self):
+
+        return max(math.ceil(self.opened + self.reset - time()), 1)
+
+
+    def allow(self):
+        """ indica si se puede llamar a la API (y si es la llamada de prueba, la marca) """
+
+        with self.lock:
+            if self.count < self.failures:
+                return True
+            if self.is_open():
+                return False
+            self.probing = True
+            return True
+
+
+    def success(self):
+
+        with self.lock:
+            self.count = 0
+            self.probing = False
+
+
+    def failure(self):
+
+        with self.lock:
+            self.count += 1
+            self.probing = False
+            if self.count >= self.failures:
+                self.opened = time()
+
+
+    def cancel(self):
+        """ la llamada permitida no se hizo """
+
+        with self.lock:
+            self.probing = False
+
+
+class Route53Client():
+
+    def __init__(self, config, client=None):
+        """ cliente de Route53 para usar desde varios threads
+
+            todos los threads del proceso usan un solo cliente de boto3 (los clientes se
+            pueden compartir, las sessions no, asi que se crea una vez con un lock), con un
+            pool de route53_max_connections conexiones keep-alive y los reintentos de
+            route53_retry_mode. Antes de cada llamada se toma un token de route53_rate llamadas por segundo
+            (la cuota de Route53 es 5 por cuenta; 0 no limita), esperando hasta
+            route53_rate_wait segundos. Despues de route53_breaker_failures errores
+            seguidos de la API, las llamadas fallan en el momento con CircuitOpen durante
+            route53_breaker_reset segundos.
+
+            Con client (por ejemplo, el falso de bench/) se usa ese.
+        """
+
+        self.config = config
+        self.client = client
+        self.client_lock = Lock()
+
+        if not client:
+            self.client_config = client_config(self.config)
+
+        rate = float(self.config.get('route53_rate', 5))
+
+        self.limiter = None
+        self.account = self.config.get('aws_id') or 'default'
+        self.max_wait = float(self.config.get('route53_rate_wait', 2))
+
+        if rate:
+            self.limiter = account_limiter(self.config, rate, float(self.config.get('route53_burst', rate)))
+
+        self.breaker = CircuitBreaker(
+            int(self.config.get('route53_breaker_failures', 5)),
+            float(self.config.get('route53_breaker_reset', 30)),
+        )
+
+
+    def _client(self):
+
+        if self.client:
+            return self.client
+
+        with self.client_lock:
+            if not self.client:
+                session = boto3.session.Session(
+                    aws_access_key_id=self.config['aws_id'],
+                    aws_secret_access_key=self.config['aws_secret'],
+                )
+                self.client = session.client('route53', config=self.client_config)
+
+        return self.client
+
+
+    def _throttle(self):
+
+        waited = 0
+
+        while True:
+            wait = self.limiter.delay(self.account)
+            if not wait:
+                return
+            if waited + wait > self.max_wait:
+                raise Throttled('Route53 rate limit reached', math.ceil(wait))
+            sleep(wait)
+            waited += wait
+
+
+    def call(self, operation, **kwargs):
+
+        if not self.breaker.allow():
+            raise CircuitOpen('Route53 is unavailable (circuit breaker open)', self.breaker.retry_after())
+
+        try:
+            if self.limiter:
+                self._throttle()
+            response = getattr(self._client(), operation)(**kwargs)
+        except Throttled:
+            self.breaker.cancel()
+            raise
+        except Exception as e:
+            if unhealthy(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+
+        self.breaker.success()
+
+        return response
+
+
+    def __getattr__(self, name):
+
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        if name in ['get_paginator', 'get_waiter', 'meta']:
+            return getattr(self._client(), name)
+
+        return partial(self.call, name)
@@ -0,0 +1,182 @@
+import logging
+import re
+from fractions import Fraction
+
+from backend.local import LocalBackend
+from backend.revocation import revocation_file
+from backend.route53 import Route53Backend
+
+
+shard_backends = {
+    'Route53' : Route53Backend,
+    'Local' : LocalBackend,
+}
+
+
+class ShardMap():
+
+    def __init__(self, shards):
+        """ asigna cada hash al shard que tiene el prefijo hex mas largo que coincide
+
+            los prefijos de todos los shards no se pueden solapar y tienen que cubrir
+            todos los hashes posibles (por ejemplo, '0'...'f', o '0', '1'...'7', '8a', ...)
+        """
+
+        self.prefixes = {}
+
+        for shard in shards:
+            for prefix in shard.get('prefixes', []):
+                prefix = prefix.lower()
+                if not re.match('^[0-9a-f]+$', prefix):
+                    raise Exception('InvalidConfig', 'Invalid shard prefix ({})'.format(prefix))
+                if prefix in self.prefixes:
+                    raise Exception('InvalidConfig', 'Shard prefix {} is used more than once'.format(prefix))
+                self.prefixes[prefix] = shard['name']
+
+        self.lengths = sorted(set([ len(p) for p in self.prefixes ]))
+
+        for prefix in self.prefixes:
+            for length in self.lengths:
+                if length < len(prefix) and prefix[:length] in self.prefixes:
+                    raise Exception('InvalidConfig', 'Shard prefixes {} and {} overlap'.format(prefix[:length], prefix))
+
+        if sum([ Fraction(1, 16 ** len(p)) for p in self.prefixes ]) != 1:
+            raise Exception('InvalidConfig', 'Shard prefixes must cover every hash')
+
+
+    def shard(self, registry):
+        """ nombre del shard que guarda el registro """
+
+        for length in self.lengths:
+            name = self.prefixes.get(registry[:length])
+            if name is not None:
+                return name
+
+
+class ShardedBackend():
+
+    def __init__(self, config):
+        """ reparte los registros entre varios backends (por ejemplo, una hosted zone de
+            Route53 por shard, cada una con su cliente y su batcher) segun los primeros
+            digitos hex del hash
+
+            cada elemento de shards tiene name, prefixes, backend (Route53 por defecto) y
+            los valores de config propios del shard (domain, route53_zone_id, etc), el resto
+            se toma de la config general.
+
+            Mientras se mueven registros con asydns-shards.py, shards_previous tiene la
+            distribucion anterior: un hash que no esta en su shard nuevo se busca en el
+            anterior, para no perder las revocaciones que todavia no se movieron.
+        """
+
+        self.config = config
+
+        self.logger = logging.getLogger('asydnsd')
+
+        if not self.config.get('shards'):
+            raise Exception('InvalidConfig', 'Missing required value shards')
+
+        self.backends = {}
+
+        for i, shard in enumerate(self.config['shards'] + self.config.get('shards_previous', [])):
+            shard.setdefault('name', str(i))
+            if shard['name'] not in self.backends:
+                self.backends[shard['name']] = self._backend(shard)
+
+        self.map = ShardMap(self.config['shards'])
+        self.previous = None
+
+        if self.config.get('shards_previous'):
+            self.previous = ShardMap(self.config['shards_previous'])
+
+
+    def _backend(self, shard):
+
+        shard_config = { k:v for k,v in self.config.items() if k not in ['backend', 'shards', 'shards_previous'] }
+        shard_config.update({ k:v for k,v in shard.items() if k not in ['name', 'prefixes'] })
+
+        if 'revocation_file' not in shard:
+            path = revocation_file(self.config)
+            shard_config['revocation_file'] = str(path.with_name('{}-{}{}'.format(path.stem, shard['name'], path.suffix)))
+
+        backend_class = shard_backends.get(shard_config.get('backend', 'Route53'))
+
+        if not backend_class:
+            raise Exception('InvalidConfig', 'Invalid backend for shard {}. Options: {}'.format(shard['name'], ','.join(shard_backends.keys())))
+
+        return backend_class(shard_config)
+
+
+    def set_metrics(self, metrics):
+
+        for backend in self.backends.values():
+            if hasattr(backend, 'set_metrics'):
+                backend.set_metrics(metrics)
+
+
+    def ready(self):
+
+        return all([ b.ready() for b in self.backends.values() if hasattr(b, 'ready') ])
+
+
+    def shard(self, registry):
+        """ backend que guarda el registro """
+
+        return self.backends[self.map.shard(registry)]
+
+
+    def name(self, registry):
+
+        return self.shard(registry).name(registry)
+
+
+    def revoke(self, registry):
+
+        return self.shard(registry).revoke(registry)
+
+
+    def update(self, registry, ip):
+
+        return self.shard(registry).update(registry, ip)
+
+
+    def update_many(self, updates):
+        """ agrupa los cambios por shard, asi cada uno los aplica en sus propios ChangeBatch """
+
+        by_shard = {}
+
+        for registry, ip in updates:
+            by_shard.setdefault(self.map.shard(registry), []).append((registry, ip))
+
+        for name, shard_updates in by_shard.items():
+            self.backends[name].update_many(shard_updates)
+
+
+    def dump(self):
+        """ recorre los registros y las revocaciones de todos los shards """
+
+        for backend in self.backends.values():
+            for record in backend.dump():
+                yield record
+
+
+    def check(self, registry):
+
+        backend = self.shard(registry)
+        current = backend.check(registry)
+
+        if current['status'] != 'non-registered' or not self.previous:
+            return current
+
+        previous = self.backends[self.previous.shard(registry)]
+
+        if previous is not backend and previous.check(registry)['status'] == 'revoked':
+            return { 'status' : 'revoked', 'name' : current['name'] }
+
+        return current
+
+
+    def confirm(self, registry):
+        """ las respuestas con cached de check vienen del shard (que tiene confirm) """
+
+        return self.shard(registry).confirm(registry)
@@ -0,0 +1,403 @@
+import fcntl
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from ipaddress import IPv4Address, IPv6Address, ip_address
+from threading import RLock, Thread
+
+
+MAGIC = b'ASYDNS01'
+
+# records.dat: cabecera + registros de tamanio fijo, en orden de alta
+#   cabecera: magic, cantidad de registros, generacion del indice
+#   registro: digest sha224 (28), direccion (16), ultima actualizacion (4), seq (2), flags (1)
+DAT_HEADER = struct.Struct('<8sQQ')
+DAT_HEADER_SIZE = 64
+RECORD = struct.Struct('<28s16sIHB')
+SEQ = struct.Struct('<H')
+SEQ_OFFSET = 48
+
+# records.idx: cabecera + tabla hash de direccionamiento abierto (sondeo lineal)
+#   cabecera: magic, cantidad de slots (potencia de 2), generacion
+#   slot: numero de registro + 1 (0 es vacio)
+IDX_HEADER = struct.Struct('<8sQQ')
+IDX_HEADER_SIZE = 32
+SLOT = struct.Struct('<I')
+
+# primeros 8 bytes del digest, para elegir el slot
+KEY = struct.Struct('<Q')
+
+FLAG_REVOKED = 1
+FLAG_IPV6 = 2
+
+# con MAX_LOAD se empieza a reconstruir el indice en segundo plano, con HARD_LOAD las
+# altas esperan a que termine
+MAX_LOAD = 0.75
+HARD_LOAD = 0.9
+INITIAL_SLOTS = 1024
+
+
+class RecordStore():
+
+    def __init__(self, directory, writable=True):
+        """ registros de tamanio fijo en archivos mapeados en memoria
+
+            el digest binario de 28 bytes es la clave. Los datos estan en records.dat
+            (51 bytes por registro, y el archivo crece de a 1/16) y el indice en
+            records.idx (un uint32 por slot, con carga entre 0.375 y 0.9), o sea entre 55 y
+            65 bytes por clave registrada, segun la carga.
+
+            Cuando el indice pasa la carga de 0.75 se arma uno del doble de slots en otro
+            thread (en un solo proceso a la vez, con flock sobre records.grow), leyendo los
+            digests directo del mapeo de records.dat, y solo los registros agregados
+            mientras tanto se insertan con el lock de escritura tomado.
+
+            Un solo proceso escribe a la vez (flock sobre records.lock). Los lectores no
+            toman locks: cada registro tiene un seq que el escritor deja impar mientras
+            lo modifica, y cuando se reconstruye el indice se incrementa la generacion en
+            la cabecera de records.dat, asi los lectores saben que tienen que remapearlo.
+        """
+
+        self.directory = directory
+        self.writable = writable
+
+        self.dat_path = self.directory / 'records.dat'
+        self.idx_path = self.directory / 'records.idx'
+
+        self.lock = RLock()
+        self.rebuilding = False
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock_file = (self.directory / 'records.lock').open('a')
+
+        with self._write_lock():
+            self._create()
+
+        self.dat = None
+        self.idx = None
+        self._map_dat()
+        self._map_idx()
+
+
+    @contextmanager
+    def _write_lock(self):
+
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+
+    def _create(self):
+
+        if not self.dat_path.is_file():
+            with self.dat_path.open('wb') as f:
+                f.write(DAT_HEADER.pack(MAGIC, 0, 0).ljust(DAT_HEADER_SIZE, b'\0'))
+                f.truncate(DAT_HEADER_SIZE + INITIAL_SLOTS * RECORD.size)
+
+        if not self.idx_path.is_file():
+            tmp, table = self._new_index(INITIAL_SLOTS)
+            self._install_index(tmp, table, INITIAL_SLOTS, 0)
+
+
+    def _map_dat(self):
+
+        with self.dat_path.open('r+b' if self.writable else 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+            dat = mmap.mmap(f.fileno(), size, access=access)
+
+        if dat[:8] != MAGIC:
+            raise Exception('InvalidStore', 'Invalid record store {}'.format(self.dat_path))
+
+        self.dat = dat
+        self.dat_records = (size - DAT_HEADER_SIZE) // RECORD.size
+
+
+    def _map_idx(self):
+
+        with self.idx_path.open('r+b' if self.writable else 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+            idx = mmap.mmap(f.fileno(), size, access=access)
+
+        magic, slots, generation = IDX_HEADER.unpack_from(idx, 0)
+
+        self.idx = idx
+        self.slots = slots
+        self.mask = slots - 1
+        self.generation = generation
+
+
+    def _header(self):
+        """ devuelve (cantidad de registros, generacion del indice) """
+
+        magic, count, generation = DAT_HEADER.unpack_from(self.dat, 0)
+
+        return count, generation
+
+
+    def _refresh(self):
+        """ remapea lo que haya cambiado otro proceso (indice reconstruido o datos crecidos) """
+
+        count, generation = self._header()
+
+        if generation != self.generation:
+            self._map_idx()
+
+        if count > self.dat_records:
+            self._map_dat()
+
+        return count
+
+
+    def _offset(self, number):
+
+        return DAT_HEADER_SIZE + number * RECORD.size
+
+
+    def _find(self, digest):
+        """ devuelve el numero de registro del digest, o None """
+
+        h = int.from_bytes(digest[:8], 'little') & self.mask
+        idx = self.idx
+
+        while True:
+            value, = SLOT.unpack_from(idx, IDX_HEADER_SIZE + h * SLOT.size)
+            if not value:
+                return None
+            number = value - 1
+            if number >= self.dat_records:
+                # otro proceso agrego registros despues de que mapeamos los datos
+                self._map_dat()
+            offset = self._offset(number)
+            if self.dat[offset:offset + 28] == digest:
+                return number
+            h = (h + 1) & self.mask
+
+
+    def _new_index(self, slots):
+        """ crea records.tmp con una tabla vacia de slots, devuelve (path, mapeo) """
+
+        tmp = self.idx_path.with_suffix('.tmp')
+
+        with tmp.open('w+b') as f:
+            f.truncate(IDX_HEADER_SIZE + slots * SLOT.size)
+            table = mmap.mmap(f.fileno(), 0)
+
+        return tmp, table
+
+
+    def _fill_index(self, table, slots, first, last):
+        """ inserta en la tabla los registros first..last-1, leyendo los digests de records.dat """
+
+        dat = self.dat
+        mask = slots - 1
+
+        for number in range(first, last):
+            h = KEY.unpack_from(dat, DAT_HEADER_SIZE + number * RECORD.size)[0] & mask
+            while SLOT.unpack_from(table, IDX_HEADER_SIZE + h * SLOT.size)[0]:
+                h = (h + 1) & mask
+            SLOT.pack_into(table, IDX_HEADER_SIZE + h * SLOT.size, number + 1)
+
+
+    def _install_index(self, tmp, table, slots, generation):
+
+        IDX_HEADER.pack_into(table, 0, MAGIC, slots, generation)
+        table.flush()
+        table.close()
+
+        tmp.rename(self.idx_path)
+
+
+    def _start_rebuild(self):
+
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+
+        Thread(target=self._rebuild_index, daemon=True).start()
+
+
+    def _rebuild_index(self, blocking=False):
+        """ reemplaza el indice por uno del doble de slots, si sigue haciendo falta
+
+            la mayor parte se arma sin el lock de escritura (los registros no se mueven ni
+            cambian de digest), y al final se agregan los registros nuevos y se incrementa
+            la generacion, asi los demas procesos remapean el indice
+        """
+
+        try:
+            with (self.directory / 'records.grow').open('a') as grow:
+
+                try:
+                    fcntl.flock(grow, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # otro proceso lo esta reconstruyendo
+                    return
+
+                try:
+                    with self.lock:
+                        count = self._refresh()
+
+                    if count + 1 <= self.slots * MAX_LOAD:
+                        # ya lo reconstruyo otro proceso
+                        return
+
+                    slots = self.slots * 2
+                    tmp, table = self._new_index(slots)
+
+                    self._fill_index(table, slots, 0, count)
+
+                    with self._write_lock():
+                        last = self._refresh()
+                        self._fill_index(table, slots, count, last)
+                        generation = self._header()[1] + 1
+                        self._install_index(tmp, table, slots, generation)
+                        DAT_HEADER.pack_into(self.dat, 0, MAGIC, last, generation)
+                        self._map_idx()
+                finally:
+                    # explicitamente, por si un proceso hijo tiene una copia del archivo
+                    fcntl.flock(grow, fcntl.LOCK_UN)
+        finally:
+            with self.lock:
+                self.rebuilding = False
+
+
+    def _grow_dat(self, count):
+
+        with self.dat_path.open('r+b') as f:
+            f.truncate(self._offset(count + max(count // 16, INITIAL_SLOTS)))
+
+        self._map_dat()
+
+
+    def lookup(self, digest):
+        """ devuelve el numero de registro del digest (28 bytes), o None """
+
+        with self.lock:
+            self._refresh()
+            return self._find(digest)
+
+
+    def read(self, number):
+        """ devuelve (direccion, actualizacion, flags, seq) del registro, de forma consistente """
+
+        offset = self._offset(number)
+
+        while True:
+            digest, address, updated, seq, flags = RECORD.unpack_from(self.dat, offset)
+            if seq % 2 == 0 and SEQ.unpack_from(self.dat, offset + SEQ_OFFSET)[0] == seq:
+                break
+
+        if flags & FLAG_REVOKED:
+            address = None
+        elif flags & FLAG_IPV6:
+            address = str(IPv6Address(address))
+        else:
+            address = str(IPv4Address(address[:4]))
+
+        return address, updated, flags, seq
+
+
+    def seq(self, number):
+        """ seq actual del registro (cambia con cada modificacion) """
+
+        return SEQ.unpack_from(self.dat, self._offset(number) + SEQ_OFFSET)[0]
+
+
+    def get(self, registry):
+        """ devuelve (direccion, actualizacion, revocado) para el hash hex, o None """
+
+        number = self.lookup(bytes.fromhex(registry))
+
+        if number is None:
+            return None
+
+        address, updated, flags, seq = self.read(number)
+
+        return address, updated, bool(flags & FLAG_REVOKED)
+
+
+    def count(self):
+
+        return self._header()[0]
+
+
+    def _set(self, registry, address, updated, flags):
+
+        digest = bytes.fromhex(registry)
+
+        while not self._try_set(digest, address, updated, flags):
+            # el indice esta lleno: se espera la reconstruccion (o se hace aca)
+            self._rebuild_index(blocking=True)
+
+
+    def _try_set(self, digest, address, updated, flags):
+        """ escribe el registro, devuelve False si es un alta y el indice esta lleno """
+
+        with self._write_lock():
+
+            count = self._refresh()
+            number = self._find(digest)
+
+            if number is None:
+                if count + 1 > self.slots * HARD_LOAD:
+                    return False
+                if count + 1 > self.slots * MAX_LOAD:
+                    self._start_rebuild()
+                if count + 1 > self.dat_records:
+                    self._grow_dat(count + 1)
+                number = count
+                RECORD.pack_into(self.dat, self._offset(number), digest, address, updated, 0, flags)
+                count, generation = self._header()
+                DAT_HEADER.pack_into(self.dat, 0, MAGIC, count + 1, generation)
+                h = KEY.unpack_from(digest)[0] & self.mask
+                while SLOT.unpack_from(self.idx, IDX_HEADER_SIZE + h * SLOT.size)[0]:
+                    h = (h + 1) & self.mask
+                SLOT.pack_into(self.idx, IDX_HEADER_SIZE + h * SLOT.size, number + 1)
+                return True
+
+            offset = self._offset(number)
+            seq = self.seq(number)
+
+            if RECORD.unpack_from(self.dat, offset)[4] & FLAG_REVOKED:
+                # una revocacion es definitiva, los cambios posteriores se ignoran
+                return True
+
+            SEQ.pack_into(self.dat, offset + SEQ_OFFSET, (seq + 1) % 65536)
+            RECORD.pack_into(self.dat, offset, digest, address, updated, (seq + 1) % 65536, flags)
+            SEQ.pack_into(self.dat, offset + SEQ_OFFSET, (seq + 2) % 65536)
+
+            return True
+
+
+    def set(self, registry, address, updated):
+        """ guarda la direccion del registro (salvo que este revocado) """
+
+        packed = ip_address(address).packed
+        flags = FLAG_IPV6 if len(packed) == 16 else 0
+
+        self._set(registry, packed.ljust(16, b'\0'), updated, flags)
+
+
+    def revoke(self, registry, updated):
+
+        self._set(registry, b'\0' * 16, updated, FLAG_REVOKED)
+
+
+    def items(self):
+        """ recorre todos los registros: (hash hex, direccion, actualizacion, revocado) """
+
+        with self.lock:
+            count = self._refresh()
+
+        for number in range(count):
+            offset = self._offset(number)
+            digest = self.dat[offset:offset + 28]
+            address, updated, flags, seq = self.read(number)
+            yield digest.hex(), address, updated, bool(flags & FLAG_REVOKED)
@@ -0,0 +1,356 @@
+"""Load test of the REST API, against a local fake Route53 (or the Local backend)
+
+Run it from the repo root, e.g.:
+
+    python3 -m bench.bench -n 200 -c 8 --latency 0.05 --rate 5 -o results.json
+
+Every flow uses its own client key and does GET+POST (register), GET+POST (refresh,
+same address) and GET+DELETE (revoke). The latency of the requests and of the
+server phases (challenge, verify, check, update, revoke) is reported, and saved as
+JSON with -o so runs of different releases can be compared.
+"""
+
+import base64
+import importlib
+import json
+import math
+import platform
+import subprocess
+import tempfile
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, local
+from time import perf_counter, strftime
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import click
+import falcon.testing
+import requests
+
+import asydnsd
+from backend.local import LocalBackend
+from backend.route53 import Route53Backend
+from bench.fake_route53 import FakeRoute53
+
+client_keys = importlib.import_module('asydns-client')
+
+
+class Phases():
+
+    def __init__(self):
+        """Latency samples and errors, per phase"""
+
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.lock = Lock()
+
+
+    @contextmanager
+    def measure(self, name):
+
+        start = perf_counter()
+
+        try:
+            yield
+        except Exception:
+            with self.lock:
+                self.errors[name] += 1
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            with self.lock:
+                self.samples[name].append(elapsed)
+
+
+    def wrap(self, name, fn):
+
+        def timed(*args, **kwargs):
+            with self.measure(name):
+                return fn(*args, **kwargs)
+
+        return timed
+
+
+    def report(self, elapsed):
+
+        report = {}
+
+        for name, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            report[name] = {
+                'count': len(samples),
+                'errors': self.errors[name],
+                'per_second': len(samples) / elapsed,
+                'mean_ms': sum(samples) / len(samples) * 1000,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p90_ms': percentile(samples, 90) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'max_ms': samples[-1] * 1000,
+            }
+
+        return report
+
+
+def percentile(samples, p):
+    """Nearest rank percentile of sorted samples"""
+
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+class InProcessClient():
+
+    def __init__(self, app):
+        self.client = falcon.testing.TestClient(app)
+
+
+    def request(self, method, path, body=None):
+
+        result = self.client.simulate_request(method, path, body=body)
+
+        return result.status_code, result.json
+
+
+class HTTPClient():
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.local = local()
+
+
+    def request(self, method, path, body=None):
+
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+
+        r = self.local.session.request(method, self.url + path, data=body)
+
+        return r.status_code, r.json()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_keys(path, key_type, count):
+    """Returns count client keys (public PEM, sign function), generating the missing ones
+
+    The private keys are kept in path, so the next runs reuse them.
+    """
+
+    pems = []
+
+    if path.is_file():
+        with path.open() as f:
+            pems = json.load(f)
+
+    if len(pems) < count:
+        click.echo('Generating {} {} keys ...'.format(count - len(pems), key_type))
+        pems += [ client_keys.generate_key(key_type) for i in range(count - len(pems)) ]
+        with path.open('w') as f:
+            json.dump(pems, f)
+
+    return [ client_keys.load_key(key_type, pem) for pem in pems[:count] ]
+
+
+def flow(client, phases, statuses, key):
+    """Registers, refreshes and revokes a key"""
+
+    pub, sign = key
+
+    for method in ['POST', 'POST', 'DELETE']:
+
+        with phases.measure('GET'):
+            status, body = client.request('GET', '/api')
+
+        statuses['GET {}'.format(status)] += 1
+
+        if status != 200:
+            return
+
+        body = json.dumps({
+            'pub': pub,
+            'challenge': body['challenge'],
+            'response': base64.b64encode(sign(base64.b64decode(body['challenge']))).decode(),
+        })
+
+        with phases.measure(method):
+            status, result = client.request(method, '/api', body)
+
+        statuses['{} {}'.format(method, status)] += 1
+
+
+def parse_settings(settings):
+    """key=value pairs from --set, the values are parsed as JSON if they can be"""
+
+    config = {}
+
+    for setting in settings:
+        key, value = setting.split('=', maxsplit=1)
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+
+    return config
+
+
+def git_version():
+
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=str(Path(asydnsd.__file__).parent), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def build_server(workdir, backend, settings, fake):
+    """AsyDNS instance with its state (server keys, store, replay filters) in workdir"""
+
+    config = {
+        'backend': backend,
+        'domain': fake.domain,
+        'route53_zone_id': fake.zone_id,
+        'local_dir': str(workdir / 'local'),
+        'replay_file': str(workdir / 'replay'),
+        'revocation_file': str(workdir / 'revoked.bin'),
+        'metrics_dir': str(workdir / 'metrics'),
+        'ratelimit': False,
+        # the client side limit of Route53 calls (5/s) would be all the run measures
+        'route53_rate': 0,
+    }
+
+    config.update(settings)
+
+    if config['backend'] == 'Route53':
+        backend = Route53Backend(config, client=fake)
+    elif config['backend'] == 'Local':
+        backend = LocalBackend(config)
+    else:
+        raise click.ClickException('Only the Route53 and Local backends can be benchmarked')
+
+    asydns = asydnsd.AsyDNS(dotdir=workdir, config=config, backend=backend)
+
+    # the server keys are generated in the background
+    asydns.keys_ready.wait()
+
+    return asydns
+
+
+@click.command()
+@click.option('-n', 'flows', default=100, help='Flows to run (one client key each)')
+@click.option('-c', 'concurrency', default=4, help='Concurrent flows')
+@click.option('-m', 'mode', default='inprocess', type=click.Choice(['inprocess', 'http']), help='Call the app in-process or over HTTP')
+@click.option('-u', 'url', default=None, help='Benchmark an already running server instead (client side phases only)')
+@click.option('-b', 'backend', default='Route53', type=click.Choice(['Route53', 'Local']), help='Backend')
+@click.option('-t', 'key_type', default='rsa', type=click.Choice(['rsa', 'ed25519', 'ecdsa']), help='Client key type')
+@click.option('-k', 'keys_file', default=None, help='Client keys file (default: ~/.asydns/bench-keys-TYPE.json)')
+@click.option('--latency', default=0.0, help='Seconds added to each fake Route53 call')
+@click.option('--rate', default=0.0, help='Fake Route53 calls per second before throttling (0: no limit)')
+@click.option('--consistency', default=0.0, help='Seconds until a fake Route53 change is visible')
+@click.option('--set', 'settings', multiple=True, help='Server config value, as key=value (JSON values)')
+@click.option('-o', 'output', default=None, help='Save the results as JSON')
+def cmd_bench(flows, concurrency, mode, url, backend, key_type, keys_file, latency, rate, consistency, settings, output):
+    """Load test of the AsyDNS REST API"""
+
+    if not keys_file:
+        keys_file = Path.home() / '.asydns' / 'bench-keys-{}.json'.format(key_type)
+        keys_file.parent.mkdir(exist_ok=True)
+
+    keys = load_keys(Path(keys_file), key_type, flows)
+
+    settings = parse_settings(settings)
+    phases = Phases()
+    statuses = Counter()
+
+    fake = FakeRoute53('bench.asydns.test.', latency=latency, rate=rate, consistency=consistency)
+    server = None
+    asydns = None
+
+    with tempfile.TemporaryDirectory() as workdir:
+
+        if url:
+            mode = 'external'
+            client = HTTPClient(url)
+        else:
+            asydns = build_server(Path(workdir), backend, settings, fake)
+
+            asydns._challenge_body = phases.wrap('challenge', asydns._challenge_body)
+            asydns._validate_response = phases.wrap('verify', asydns._validate_response)
+            for name in ['check', 'update', 'revoke']:
+                setattr(asydns.backend, name, phases.wrap(name, getattr(asydns.backend, name)))
+
+            app = asydnsd.create_app(asydns)
+
+            if mode == 'inprocess':
+                client = InProcessClient(app)
+            else:
+                server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+                Thread(target=server.serve_forever, daemon=True).start()
+                client = HTTPClient('http://127.0.0.1:{}'.format(server.server_port))
+
+        click.echo('Running {} flows, {} at a time ({}) ...'.format(flows, concurrency, mode))
+
+        start = perf_counter()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for f in [ executor.submit(flow, client, phases, statuses, key) for key in keys ]:
+                f.result()
+
+        elapsed = perf_counter() - start
+
+        if server:
+            server.shutdown()
+
+    requests_done = sum(statuses.values())
+
+    results = {
+        'time': strftime('%Y-%m-%dT%H:%M:%S'),
+        'version': git_version(),
+        'python': platform.python_version(),
+        'params': {
+            'flows': flows,
+            'concurrency': concurrency,
+            'mode': mode,
+            'backend': backend,
+            'key_type': key_type,
+            'latency': latency,
+            'rate': rate,
+            'consistency': consistency,
+            'settings': settings,
+        },
+        'elapsed': elapsed,
+        'flows_per_second': flows / elapsed,
+        'requests': requests_done,
+        'requests_per_second': requests_done / elapsed,
+        'status': dict(statuses),
+        'phases': phases.report(elapsed),
+        'server_stats': dict(asydns.stats) if asydns else None,
+        'route53': { 'calls': dict(fake.calls), 'throttled': dict(fake.throttled) } if asydns and backend == 'Route53' else None,
+    }
+
+    click.echo('{:.1f} flows/s, {:.1f} requests/s in {:.1f}s'.format(results['flows_per_second'], results['requests_per_second'], elapsed))
+    click.echo('status: {}'.format(', '.join([ '{}: {}'.format(k, v) for k, v in sorted(statuses.items()) ])))
+    click.echo('{:<10} {:>7} {:>7} {:>9} {:>9} {:>9}'.format('phase', 'count', 'errors', 'p50 ms', 'p99 ms', 'max ms'))
+
+    for name, phase in results['phases'].items():
+        click.echo('{:<10} {:>7} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}'.format(name, phase['count'], phase['errors'], phase['p50_ms'], phase['p99_ms'], phase['max_ms']))
+
+    if results['route53']:
+        click.echo('route53 calls: {} (throttled: {})'.format(dict(fake.calls), dict(fake.throttled)))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+        click.echo('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    cmd_bench()
@@ -0,0 +1,196 @@
+from collections import Counter, deque
+from threading import Lock
+from time import sleep, time
+
+from botocore.exceptions import ClientError
+
+
+def fqdn(name):
+    return name.rstrip('.') + '.'
+
+
+class FakeRoute53():
+
+    def __init__(self, domain, zone_id='ZBENCH', latency=0, rate=0, consistency=0):
+        """In-memory stand-in for the boto3 Route53 client (only the calls AsyDNS uses)
+
+        latency:     seconds added to every call
+        rate:        calls per second before answering Throttling (0: no limit, Route53
+                     allows 5 per account)
+        consistency: seconds before a change is seen by test_dns_answer and reported
+                     as INSYNC (list_resource_record_sets sees it at once, like Route53)
+        """
+
+        self.domain = fqdn(domain)
+        self.zone_id = zone_id
+        self.latency = latency
+        self.rate = rate
+        self.consistency = consistency
+
+        self.records = {}
+        self.visible = {}
+        self.pending = deque()
+        self.changes = {}
+        self.change_id = 0
+
+        self.calls = Counter()
+        self.throttled = Counter()
+
+        self.tokens = float(rate)
+        self.refilled = time()
+
+        self.lock = Lock()
+
+
+    def _call(self, operation):
+
+        with self.lock:
+
+            self.calls[operation] += 1
+            now = time()
+
+            if self.rate:
+                self.tokens = min(float(self.rate), self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.tokens < 1:
+                    self.throttled[operation] += 1
+                    raise ClientError({ 'Error': { 'Code': 'Throttling', 'Message': 'Rate exceeded' } }, operation)
+                self.tokens -= 1
+
+            while self.pending and self.pending[0][0] <= now:
+                visible_at, name, value = self.pending.popleft()
+                if value is None:
+                    self.visible.pop(name, None)
+                else:
+                    self.visible[name] = value
+
+        if self.latency:
+            sleep(self.latency)
+
+
+    def _error(self, code, message, operation):
+
+        raise ClientError({ 'Error': { 'Code': code, 'Message': message } }, operation)
+
+
+    def get_hosted_zone(self, Id):
+
+        self._call('GetHostedZone')
+
+        return { 'HostedZone': { 'Id': Id, 'Name': self.domain } }
+
+
+    def test_dns_answer(self, HostedZoneId, RecordName, RecordType):
+
+        self._call('TestDNSAnswer')
+
+        value = self.visible.get(fqdn(RecordName))
+
+        return { 'RecordName': RecordName, 'RecordType': RecordType, 'RecordData': [ value ] if value else [] }
+
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+
+        self._call('ChangeResourceRecordSets')
+
+        with self.lock:
+
+            names = [ fqdn(c['ResourceRecordSet']['Name']) for c in ChangeBatch['Changes'] ]
+
+            if len(set(names)) != len(names):
+                self._error('InvalidChangeBatch', 'Duplicate records in the change batch', 'ChangeResourceRecordSets')
+
+            for change, name in zip(ChangeBatch['Changes'], names):
+                if change['Action'] != 'DELETE':
+                    continue
+                if name not in self.records:
+                    self._error('InvalidChangeBatch', 'Tried to delete {} but it was not found'.format(name), 'ChangeResourceRecordSets')
+                # like Route53, a DELETE must carry the current value (or the whole batch fails)
+                if change['ResourceRecordSet']['ResourceRecords'][0]['Value'] != self.records[name]:
+                    self._error('InvalidChangeBatch', 'Tried to delete {} but the values provided do not match the current values'.format(name), 'ChangeResourceRecordSets')
+
+            visible_at = time() + self.consistency
+
+            for change, name in zip(ChangeBatch['Changes'], names):
+                if change['Action'] == 'DELETE':
+                    value = None
+                    del self.records[name]
+                else:
+                    value = change['ResourceRecordSet']['ResourceRecords'][0]['Value']
+                    self.records[name] = value
+                self.pending.append((visible_at, name, value))
+
+            self.change_id += 1
+            change_id = '/change/C{}'.format(self.change_id)
+            self.changes[change_id] = visible_at
+
+        return { 'ChangeInfo': { 'Id': change_id, 'Status': 'PENDING' } }
+
+
+    def get_change(self, Id):
+
+        self._call('GetChange')
+
+        status = 'INSYNC' if time() >= self.changes.get(Id, 0) else 'PENDING'
+
+        return { 'ChangeInfo': { 'Id': Id, 'Status': status } }
+
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None, StartRecordType=None, MaxItems='300'):
+
+        self._call('ListResourceRecordSets')
+
+        with self.lock:
+            names = sorted(self.records)
+            if StartRecordName:
+                names = [ n for n in names if n >= fqdn(StartRecordName) ]
+            page = names[:int(MaxItems)]
+            rest = names[int(MaxItems):]
+            rrsets = [ { 'Name': n, 'Type': 'A', 'TTL': 300, 'ResourceRecords': [ { 'Value': self.records[n] } ] } for n in page ]
+
+        response = { 'ResourceRecordSets': rrsets, 'IsTruncated': bool(rest), 'MaxItems': MaxItems }
+
+        if rest:
+            response['NextRecordName'] = rest[0]
+            response['NextRecordType'] = 'A'
+
+        return response
+
+
+    def get_paginator(self, operation):
+        return FakePaginator(self)
+
+
+    def get_waiter(self, name):
+        return FakeWaiter(self)
+
+
+class FakePaginator():
+
+    def __init__(self, client):
+        self.client = client
+
+
+    def paginate(self, HostedZoneId):
+
+        kwargs = { 'HostedZoneId': HostedZoneId }
+
+        while True:
+            page = self.client.list_resource_record_sets(**kwargs)
+            yield page
+            if not page['IsTruncated']:
+                return
+            kwargs['StartRecordName'] = page['NextRecordName']
+            kwargs['StartRecordType'] = page['NextRecordType']
+
+
+class FakeWaiter():
+
+    def __init__(self, client):
+        self.client = client
+
+
+    def wait(self, Id, WaiterConfig=None):
+
+        while self.client.get_change(Id=Id)['ChangeInfo']['Status'] != 'INSYNC':
+            sleep(min(0.05, self.client.consistency))
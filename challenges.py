@@ -0,0 +1,126 @@
+import base64
+import hashlib
+import hmac
+import os
+from time import time
+
+
+HMAC_PREFIX = b'h1@'
+
+
+class Challenger():
+
+    def __init__(self, config, key, secret_file):
+        """Issues and opens the challenges handed out on GET
+
+        Modes (config 'challenge_mode'):
+            rsa:  addr@time@nonce encrypted with the server public key (original format)
+            hmac: h1@addr@time@nonce@kid@mac, authenticated with HMAC-SHA256 (no RSA at all)
+
+        The HMAC key is derived per epoch ('challenge_rotation' seconds) from the secret
+        stored in secret_file, so every worker rotates at the same time without coordination.
+        """
+
+        self.config = config
+        self.key = key
+        self.pub = key.publickey()
+        self.key_bytes = (key.n.bit_length() + 7) // 8
+
+        self.mode = self.config.get('challenge_mode', 'rsa')
+        self.accept_rsa = self.config.get('challenge_accept_rsa', True)
+        self.rotation = int(self.config.get('challenge_rotation', 3600))
+
+        if self.mode not in ['rsa', 'hmac']:
+            raise Exception('InvalidConfig', 'Invalid challenge_mode ({}). Options: rsa,hmac'.format(self.mode))
+
+        if not secret_file.is_file():
+            with secret_file.open('wb') as s:
+                os.chmod(str(secret_file), 0o600)
+                s.write(os.urandom(32))
+
+        with secret_file.open('rb') as s:
+            self.secret = s.read()
+
+        self._epoch_keys = {}
+
+
+    def _epoch_key(self, kid):
+
+        key = self._epoch_keys.get(kid)
+
+        if key is None:
+            key = hmac.new(self.secret, str(kid).encode(), hashlib.sha256).digest()
+            self._epoch_keys = { k:v for k,v in self._epoch_keys.items() if k >= kid - 1 }
+            self._epoch_keys[kid] = key
+
+        return key
+
+
+    def issue(self, address):
+        """Returns a new base64 encoded challenge bound to address"""
+
+        now = int(time())
+        nonce = os.urandom(16).hex()
+
+        if self.mode == 'rsa':
+            token = '{}@{}@{}'.format(address, now, nonce)
+            challenge = self.pub.encrypt(token.encode(), '0')[0]
+            return base64.b64encode(challenge).decode()
+
+        kid = now // self.rotation
+        payload = '{}@{}@{}@{}'.format(address, now, nonce, kid).encode()
+        mac = hmac.new(self._epoch_key(kid), payload, hashlib.sha256).hexdigest().encode()
+
+        return base64.b64encode(HMAC_PREFIX + payload + b'@' + mac).decode()
+
+
+    def _open_hmac(self, challenge):
+
+        payload, mac = challenge[len(HMAC_PREFIX):].rsplit(b'@', maxsplit=1)
+        address, challenge_time, nonce, kid = payload.decode().split('@')
+
+        kid = int(kid)
+        current = int(time()) // self.rotation
+
+        if kid not in [current, current - 1]:
+            raise ValueError('Challenge key expired')
+
+        expected = hmac.new(self._epoch_key(kid), payload, hashlib.sha256).hexdigest().encode()
+
+        if not hmac.compare_digest(expected, mac):
+            raise ValueError('Invalid challenge MAC')
+
+        return address, challenge_time, nonce
+
+
+    def peek(self, challenge):
+        """Returns (address, time, nonce) for HMAC challenges, None for RSA ones
+
+        Opening an HMAC challenge needs no RSA work, so its time and address can be
+        checked before verifying the client signature.
+        """
+
+        if challenge.startswith(HMAC_PREFIX) and len(challenge) != self.key_bytes:
+            return self._open_hmac(challenge)
+
+        return None
+
+
+    def open(self, challenge):
+        """Returns (address, time, nonce) from a (base64 decoded) challenge
+
+        RSA challenges are still accepted while 'challenge_accept_rsa' is enabled, so
+        clients that got their challenge before a mode switch keep working.
+        """
+
+        # an RSA challenge is always exactly as long as the server key
+        if challenge.startswith(HMAC_PREFIX) and len(challenge) != self.key_bytes:
+            return self._open_hmac(challenge)
+
+        if self.mode == 'hmac' and not self.accept_rsa:
+            raise ValueError('RSA challenges are not accepted')
+
+        decrypted_challenge = self.key.decrypt(challenge).decode()
+        challenge_addr, challenge_time, nonce = decrypted_challenge.split('@', maxsplit=2)
+
+        return challenge_addr, challenge_time, nonce
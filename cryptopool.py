@@ -0,0 +1,168 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+from Crypto.PublicKey import RSA
+
+from challenges import Challenger
+from keycache import KeyCache
+from metrics import PHASE, Metrics
+
+
+class PoolBusy(Exception):
+    pass
+
+
+def verify_response(challenger, keys, pub, challenge, response, metrics=None):
+    """Opens the challenge and checks the client signature
+
+    Returns (challenge_addr, challenge_time, sha224, cached), with sha224 set to None
+    when the signature is not valid and cached telling if the client key came from
+    the key cache. Raises on malformed input.
+
+    With metrics, the time of the key import (cache misses only), of opening the
+    challenge (decrypt) and of the signature check (verify) is recorded.
+    """
+
+    if not metrics:
+        metrics = _no_metrics
+
+    start = perf_counter()
+    client_key, cached = keys.get(pub)
+
+    if not cached:
+        metrics.observe(PHASE, perf_counter() - start, phase='key_import')
+
+    with metrics.time(PHASE, phase='decrypt'):
+        challenge_addr, challenge_time, junk = challenger.open(challenge)
+
+    with metrics.time(PHASE, phase='verify'):
+        valid = client_key.verifier.verify(challenge, response)
+
+    if not valid:
+        return challenge_addr, challenge_time, None, cached
+
+    return challenge_addr, challenge_time, client_key.sha224, cached
+
+
+_no_metrics = Metrics({ 'metrics': False })
+
+_challenger = None
+_keys = None
+_metrics = None
+
+
+def _init_worker(config, key_file, secret_file):
+
+    global _challenger, _keys, _metrics
+
+    with key_file.open() as k:
+        key = RSA.importKey(k.read())
+
+    _challenger = Challenger(config, key, secret_file)
+    _keys = KeyCache(config)
+    _metrics = Metrics(config)
+
+
+def _verify_response(pub, challenge, response):
+    return verify_response(_challenger, _keys, pub, challenge, response, _metrics)
+
+
+class CryptoPool():
+
+    def __init__(self, config, key_file, secret_file):
+        """Process pool that runs verify_response out of the request thread
+
+        'crypto_workers' sets the number of processes ('auto' uses one per core) and
+        'crypto_queue' how many verifications can be pending before submit() raises
+        PoolBusy, so the caller can answer 503 instead of queueing without limit.
+
+        verify() waits 'crypto_timeout' seconds at most. If a process of the pool dies
+        (e.g. killed by the OOM killer) the pool is built again, and the requests that
+        were in it fail with PoolBusy.
+        """
+
+        self.config = config
+        self.key_file = key_file
+        self.secret_file = secret_file
+
+        workers = self.config.get('crypto_workers', 0)
+
+        if workers == 'auto':
+            workers = os.cpu_count() or 1
+
+        self.workers = int(workers)
+        self.queue = int(self.config.get('crypto_queue', self.workers * 8))
+        self.timeout = float(self.config.get('crypto_timeout', 10))
+
+        self.slots = BoundedSemaphore(self.queue)
+        self.lock = Lock()
+
+        self.executor = self._create_executor()
+
+
+    def _create_executor(self):
+
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.config, self.key_file, self.secret_file),
+        )
+
+
+    def _rebuild(self, broken):
+        """Replaces the executor broken by a dead process (once, for all the threads that saw it)"""
+
+        with self.lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False)
+                self.executor = self._create_executor()
+
+
+    def submit(self, pub, challenge, response):
+        """Queues a verify_response call and returns its future"""
+
+        return self._submit(pub, challenge, response)[1]
+
+
+    def _submit(self, pub, challenge, response):
+
+        if not self.slots.acquire(blocking=False):
+            raise PoolBusy('Crypto queue is full')
+
+        executor = self.executor
+
+        try:
+            future = executor.submit(_verify_response, pub, challenge, response)
+        except BrokenProcessPool:
+            self.slots.release()
+            self._rebuild(executor)
+            raise PoolBusy('Crypto pool restarted')
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self.slots.release())
+
+        return executor, future
+
+
+    def verify(self, pub, challenge, response):
+        """Runs verify_response in the pool and waits for its result"""
+
+        executor, future = self._submit(pub, challenge, response)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise PoolBusy('Crypto verification timed out')
+        except BrokenProcessPool:
+            self._rebuild(executor)
+            raise PoolBusy('Crypto pool restarted')
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,300 @@
+import fcntl
+import json
+import logging
+import os
+from collections import OrderedDict
+from itertools import islice
+from threading import Condition, Thread
+from time import sleep, time
+
+from backend.batcher import RETRY_ERRORS
+
+
+def permanent(e):
+    """True for an error of the change itself (e.g. InvalidChangeBatch), that retrying will not fix"""
+
+    if getattr(e, 'retry_after', None) is not None:
+        return False
+
+    response = getattr(e, 'response', None)
+
+    if not isinstance(response, dict) or 'Error' not in response:
+        return False
+
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+
+    return response['Error'].get('Code') not in RETRY_ERRORS and status < 500
+
+
+class Journal():
+
+    def __init__(self, config, backend, journal_dir):
+        """Write-ahead journal for the changes accepted by the REST API
+
+        Every accepted update/revoke is appended to journal_dir/<pid>-<random>.log and fsynced
+        (in groups, every 'journal_fsync_interval' ms) before submit() returns. A
+        background thread then applies the changes to the backend, up to
+        'journal_apply_batch' at once (the updates with a single update_many), retrying
+        with backoff while the backend fails, and marks them as done in the journal. A
+        change the backend rejects (e.g. an InvalidChangeBatch) is logged and dropped.
+
+        Each process holds a lock on its own file. On startup, the files that are not
+        locked belong to dead processes: their pending changes are moved to the new
+        journal (that is the compaction) and the old files are removed. The random part
+        of the name keeps a new process from reusing the file of a dead one with the
+        same pid.
+
+        Only the last pending change of each registry is applied, except that a pending
+        revoke is never replaced: the updates that arrive after it are dropped.
+        """
+
+        self.config = config
+        self.backend = backend
+        self.journal_dir = journal_dir
+        self.journal_dir.mkdir(exist_ok=True)
+
+        self.logger = logging.getLogger('asydnsd')
+
+        self.fsync_interval = self.config.get('journal_fsync_interval', 5) / 1000
+        self.compact_bytes = self.config.get('journal_compact_bytes', 16 * 1024 * 1024)
+        self.apply_batch = self.config.get('journal_apply_batch', 500)
+
+        self.cond = Condition()
+        self.seq = 0
+        self.written = 0
+        self.durable = 0
+
+        # registry -> (op, address, [seq, ...]), in the order they must be applied
+        self.pending = OrderedDict()
+
+        self.path = self.journal_dir / '{}-{}.log'.format(os.getpid(), os.urandom(4).hex())
+        self.file = self.path.open('ab')
+        fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        Thread(target=self._sync_loop, daemon=True).start()
+        Thread(target=self._apply_loop, daemon=True).start()
+
+        for old in self._orphans():
+            self._recover(old)
+
+
+    def _orphans(self):
+
+        for path in sorted(self.journal_dir.glob('*.log')):
+            if path == self.path:
+                continue
+            f = path.open('rb')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            yield path, f
+
+
+    def _recover(self, orphan):
+
+        path, f = orphan
+        entries = OrderedDict()
+
+        for line in f:
+            try:
+                entry = json.loads(line.decode())
+            except ValueError:
+                # last line of a journal cut by a crash
+                continue
+            if 'done' in entry:
+                entries.pop(entry['done'], None)
+            else:
+                entries[entry['seq']] = entry
+
+        # only the last change of each registry matters, but a revoke is never undone
+        latest = OrderedDict()
+
+        for entry in entries.values():
+            previous = latest.pop(entry['registry'], None)
+            if previous and previous['op'] == 'revoke' and entry['op'] == 'update':
+                entry = previous
+            latest[entry['registry']] = entry
+
+        for entry in latest.values():
+            self.submit(entry['op'], entry['registry'], entry.get('address'), entry['time'])
+
+        self.logger.info('journal: {} pending changes recovered from {}'.format(len(entries), path))
+
+        path.unlink()
+        f.close()
+
+
+    def _write(self, entry):
+
+        self.file.write(json.dumps(entry).encode() + b'\n')
+        self.written += 1
+
+
+    def _add(self, op, registry, address, accepted):
+        """Journals a change, returns its seq (None for an update dropped by a pending revoke)"""
+
+        previous = self.pending.get(registry)
+
+        if op == 'update' and previous and previous[0] == 'revoke':
+            return None
+
+        self.seq += 1
+        seq = self.seq
+        self._write({
+            'seq': seq,
+            'op': op,
+            'registry': registry,
+            'address': address,
+            'time': accepted or int(time()),
+        })
+
+        self.pending.pop(registry, None)
+        seqs = previous[2] + [seq] if previous else [seq]
+        self.pending[registry] = (op, address, seqs)
+
+        return seq
+
+
+    def submit(self, op, registry, address=None, accepted=None):
+        """Journals a change and returns once it is on disk"""
+
+        with self.cond:
+            seq = self._add(op, registry, address, accepted)
+            target = self.written
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.durable >= target)
+
+        return seq
+
+
+    def submit_many(self, op, changes):
+        """Journals several changes [(registry, address), ...] with a single wait for the disk"""
+
+        with self.cond:
+            seqs = [ self._add(op, registry, address, None) for registry, address in changes ]
+            target = self.written
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.durable >= target)
+
+        return seqs
+
+
+    def is_pending(self, registry):
+
+        with self.cond:
+            return registry in self.pending
+
+
+    def is_revoking(self, registry):
+        """True if registry has a revoke not yet applied to the backend"""
+
+        with self.cond:
+            return self.pending.get(registry, (None,))[0] == 'revoke'
+
+
+    def _sync_loop(self):
+
+        while True:
+
+            with self.cond:
+                self.cond.wait_for(lambda: self.written > self.durable)
+
+            # let the concurrent writers join this fsync
+            sleep(self.fsync_interval)
+
+            with self.cond:
+                target = self.written
+                self.file.flush()
+
+            os.fsync(self.file.fileno())
+
+            with self.cond:
+                self.durable = target
+                self.cond.notify_all()
+
+
+    def _apply(self, chunk):
+        """Applies the changes [(registry, op, address, seqs), ...]"""
+
+        updates = [ (registry, address) for registry, op, address, seqs in chunk if op == 'update' ]
+
+        if updates:
+            self.backend.update_many(updates)
+
+        for registry, op, address, seqs in chunk:
+            if op == 'revoke':
+                self.backend.revoke(registry)
+
+
+    def _apply_one_by_one(self, chunk):
+        """Applies the changes one at a time, dropping the ones the backend rejects
+
+        Returns the changes that are finished (applied or dropped); it stops at the
+        first error that is worth a retry.
+        """
+
+        finished = []
+
+        for change in chunk:
+            try:
+                self._apply([change])
+            except Exception as e:
+                if not permanent(e):
+                    break
+                self.logger.error('journal: {} {} dropped: {}'.format(change[1], change[0], e))
+            finished.append(change)
+
+        return finished
+
+
+    def _finish(self, finished):
+        """Marks the changes as done, keeping the ones that arrived while applying them"""
+
+        with self.cond:
+            for registry, op, address, seqs in finished:
+                current = self.pending.get(registry)
+                if current and current[2] == seqs:
+                    del self.pending[registry]
+                elif current:
+                    # a newer change arrived while applying, keep only the new seqs
+                    self.pending[registry] = (current[0], current[1], current[2][len(seqs):])
+                for seq in seqs:
+                    self._write({ 'done': seq })
+            if not self.pending and self.path.stat().st_size > self.compact_bytes:
+                self.file.flush()
+                self.file.truncate(0)
+            self.cond.notify_all()
+
+
+    def _apply_loop(self):
+
+        backoff = 1
+
+        while True:
+
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending)
+                chunk = [
+                    (registry, op, address, seqs)
+                    for registry, (op, address, seqs) in islice(self.pending.items(), self.apply_batch)
+                ]
+
+            try:
+                self._apply(chunk)
+                finished = chunk
+            except Exception as e:
+                self.logger.error(e)
+                # one invalid change makes the whole ChangeBatch fail
+                finished = self._apply_one_by_one(chunk) if permanent(e) else []
+
+            if finished:
+                self._finish(finished)
+
+            if len(finished) < len(chunk):
+                sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            backoff = 1
@@ -0,0 +1,229 @@
+import hashlib
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from Crypto.Hash import SHA224
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+except ImportError:
+    serialization = None
+
+
+ClientKey = namedtuple('ClientKey', ['key', 'verifier', 'sha224', 'type'])
+
+KEY_TYPES = ['rsa', 'ed25519', 'ecdsa-p256']
+
+# rough size of a parsed RSA key plus its verifier, on top of the PEM itself
+ENTRY_OVERHEAD = 2048
+
+
+class InvalidKeySize(ValueError):
+    pass
+
+
+class RSAVerifier():
+    """PKCS#1 v1.5 signature of the SHA224 of the challenge (the original protocol)"""
+
+    def __init__(self, key):
+        self.verifier = PKCS1_v1_5.new(key)
+
+
+    def verify(self, challenge, signature):
+        return self.verifier.verify(SHA224.new(challenge), signature)
+
+
+class Ed25519Verifier():
+    """Ed25519 signature of the challenge"""
+
+    def __init__(self, key):
+        self.key = key
+
+
+    def verify(self, challenge, signature):
+        try:
+            self.key.verify(signature, challenge)
+        except InvalidSignature:
+            return False
+        return True
+
+
+class ECDSAVerifier():
+    """ECDSA P-256 signature (DER encoded) of the SHA256 of the challenge"""
+
+    def __init__(self, key):
+        self.key = key
+
+
+    def verify(self, challenge, signature):
+        try:
+            self.key.verify(signature, challenge, ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            return False
+        return True
+
+
+def key_types(config):
+    """Client key types accepted (config 'client_key_types'), only RSA without cryptography"""
+
+    types = config.get('client_key_types', KEY_TYPES)
+
+    if not serialization:
+        return [ t for t in types if t == 'rsa' ]
+
+    return types
+
+
+def load_key(pem, types=KEY_TYPES, rsa_bits=(1024, 4096)):
+    """Parses a client public key (PEM bytes) and returns its ClientKey
+
+    The name of a key is the SHA224 of its SubjectPublicKeyInfo DER encoding, for
+    every key type, so names are always 56 hex chars. Ed25519 and ECDSA keys need
+    the cryptography package. RSA keys outside rsa_bits (min, max) raise InvalidKeySize.
+    """
+
+    key = None
+
+    if serialization:
+        try:
+            key = serialization.load_pem_public_key(pem)
+        except ValueError:
+            # RSA.importKey also reads other formats of RSA keys
+            pass
+
+    if key is None or isinstance(key, rsa.RSAPublicKey):
+        key = RSA.importKey(pem)
+        if not rsa_bits[0] <= key.size_in_bits() <= rsa_bits[1]:
+            raise InvalidKeySize('Invalid RSA key size ({} bits)'.format(key.size_in_bits()))
+        key_type, verifier, der = 'rsa', RSAVerifier(key), key.exportKey(format='DER')
+    elif isinstance(key, ed25519.Ed25519PublicKey):
+        key_type, verifier = 'ed25519', Ed25519Verifier(key)
+    elif isinstance(key, ec.EllipticCurvePublicKey) and isinstance(key.curve, ec.SECP256R1):
+        key_type, verifier = 'ecdsa-p256', ECDSAVerifier(key)
+    else:
+        raise ValueError('Unsupported key type')
+
+    if key_type not in types:
+        raise ValueError('Key type {} is not accepted'.format(key_type))
+
+    if key_type != 'rsa':
+        der = key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    return ClientKey(key, verifier, SHA224.new(der).hexdigest(), key_type)
+
+
+class KeyCache():
+
+    def __init__(self, config):
+        """LRU of parsed client public keys, keyed by the raw PEM bytes
+
+        Only the key types in 'client_key_types' are loaded (see load_key), and RSA
+        keys between 'client_key_min_bits' and 'client_key_max_bits'.
+
+        Bounded by 'key_cache_entries' and by 'key_cache_bytes' (estimated memory).
+        Setting 'key_cache_entries' to 0 disables the cache.
+
+        It also remembers the names of keys loaded by another process (the crypto
+        pool), by the SHA224 of their PEM, up to 'key_cache_entries' of them.
+        """
+
+        self.config = config
+
+        self.max_entries = int(self.config.get('key_cache_entries', 100000))
+        self.max_bytes = int(self.config.get('key_cache_bytes', 256 * 1024 * 1024))
+
+        self.types = key_types(self.config)
+        self.rsa_bits = (
+            int(self.config.get('client_key_min_bits', 1024)),
+            int(self.config.get('client_key_max_bits', 4096)),
+        )
+
+        self.entries = OrderedDict()
+        self.names = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = Lock()
+
+
+    def _load(self, pem):
+
+        return load_key(pem, self.types, self.rsa_bits)
+
+
+    def name(self, pem):
+        """Returns the name (sha224) of the key of the given PEM if it is known (without loading it), or None"""
+
+        if isinstance(pem, str):
+            pem = pem.encode()
+
+        with self.lock:
+            entry = self.entries.get(pem)
+            if entry is not None:
+                return entry.sha224
+            return self.names.get(hashlib.sha224(pem).digest())
+
+
+    def remember(self, pem, sha224):
+        """Records the name of a key loaded by another process, for name()"""
+
+        if not self.max_entries:
+            return
+
+        if isinstance(pem, str):
+            pem = pem.encode()
+
+        fingerprint = hashlib.sha224(pem).digest()
+
+        with self.lock:
+            self.names.pop(fingerprint, None)
+            self.names[fingerprint] = sha224
+            while len(self.names) > self.max_entries:
+                self.names.popitem(last=False)
+
+
+    def get(self, pem):
+        """Returns (ClientKey, hit) for the given PEM (str or bytes)"""
+
+        if isinstance(pem, str):
+            pem = pem.encode()
+
+        with self.lock:
+            entry = self.entries.get(pem)
+            if entry is not None:
+                self.entries.move_to_end(pem)
+                self.hits += 1
+                return entry, True
+            self.misses += 1
+
+        entry = self._load(pem)
+
+        if not self.max_entries:
+            return entry, False
+
+        with self.lock:
+            if pem not in self.entries:
+                self.entries[pem] = entry
+                self.size += len(pem) + ENTRY_OVERHEAD
+
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                old_pem, old_entry = self.entries.popitem(last=False)
+                self.size -= len(old_pem) + ENTRY_OVERHEAD
+
+        return entry, False
+
+
+    def stats(self):
+
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,409 @@
+import fcntl
+import json
+import os
+import pwd
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+from threading import Lock, Timer
+from time import perf_counter
+
+
+# upper bounds (seconds) of the histogram buckets, from a cached key to a slow Route53 call
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PHASE = 'asydns_phase_duration_seconds'
+OUTCOMES = 'asydns_outcomes_total'
+
+DESCRIPTIONS = {
+    'asydns_http_request_duration_seconds': 'Time to answer a request, per route, method and status',
+    'asydns_phase_duration_seconds': 'Time spent in each phase of a request',
+    'asydns_outcomes_total': 'Requests per outcome',
+    'asydns_route53_call_duration_seconds': 'Time of each Route53 API call, per operation',
+    'asydns_route53_errors_total': 'Failed Route53 API calls, per operation and error code',
+}
+
+
+def metrics_dir(config):
+    """Directory of the per process files (config 'metrics_dir', or a per user one in /dev/shm)"""
+
+    if config.get('metrics_dir'):
+        return Path(config['metrics_dir'])
+
+    shm = Path('/dev/shm')
+
+    if shm.is_dir():
+        return shm / 'asydns-metrics-{}'.format(os.getuid())
+
+    return Path(pwd.getpwuid(os.getuid()).pw_dir) / '.asydns' / 'metrics'
+
+
+def _labels(labels):
+
+    return tuple(sorted(labels.items()))
+
+
+def _add(counters, histograms, snapshot):
+    """Adds the values of a snapshot (as written by Metrics.flush) to counters and histograms"""
+
+    for name, labels, value in snapshot['counters']:
+        counters[(name, tuple([ tuple(l) for l in labels ]))] += value
+
+    for name, labels, values in snapshot['histograms']:
+        key = (name, tuple([ tuple(l) for l in labels ]))
+        if key in histograms:
+            histograms[key] = [ a + b for a, b in zip(histograms[key], values) ]
+        else:
+            histograms[key] = values
+
+
+def _alive(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class _Disabled():
+
+    def _observe(self, name, labels, seconds):
+        pass
+
+
+_disabled = _Disabled()
+
+
+class _Timer():
+
+    __slots__ = ['metrics', 'name', 'labels', 'start']
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.metrics._observe(self.name, self.labels, perf_counter() - self.start)
+
+
+class Metrics():
+
+    def __init__(self, config):
+        """Counters and latency histograms, exported in the Prometheus text format
+
+        Recording only updates a dict under a lock. Each process writes its values to
+        its own file in metrics_dir() ('metrics_flush_interval' seconds after the first
+        change since the last write), and render() adds up the files of every live
+        process, so any gunicorn worker (or crypto pool process) can answer /metrics
+        for all of them. The values of dead processes are moved to archive.json, so the
+        totals never go down (Prometheus would take that as a counter reset).
+
+        'metrics' set to false disables the recording.
+        """
+
+        self.enabled = config.get('metrics', True)
+        self.interval = float(config.get('metrics_flush_interval', 5))
+        self.directory = metrics_dir(config)
+        self.archive = self.directory / 'archive.json'
+
+        self._reset()
+
+        if self.enabled:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if hasattr(os, 'register_at_fork'):
+                # a forked worker starts from zero, its parent keeps reporting its own values
+                os.register_at_fork(after_in_child=self._reset)
+
+
+    def _reset(self):
+
+        self.pid = os.getpid()
+        self.path = self.directory / 'metrics-{}.json'.format(self.pid)
+
+        self.counters = Counter()
+        self.histograms = {}
+        self.scheduled = False
+        self.lock = Lock()
+        self.flush_lock = Lock()
+
+
+    def _changed(self):
+        """Schedules a flush, if there is none pending (called with the lock held)"""
+
+        if not self.scheduled:
+            self.scheduled = True
+            timer = Timer(self.interval, self.flush)
+            timer.daemon = True
+            timer.start()
+
+
+    def count(self, name, n=1, **labels):
+        """Adds n to the counter name{labels}"""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[(name, _labels(labels))] += n
+            self._changed()
+
+
+    def _observe(self, name, labels, seconds):
+
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [0] * (len(BUCKETS) + 2)
+            # one count per bucket (the last one is +Inf), then the sum
+            histogram[bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            self._changed()
+
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration in the histogram name{labels}"""
+
+        if self.enabled:
+            self._observe(name, _labels(labels), seconds)
+
+
+    def time(self, name, **labels):
+        """Context manager that records the time of its block in the histogram name{labels}"""
+
+        return _Timer(self if self.enabled else _disabled, name, _labels(labels))
+
+
+    def _snapshot(self):
+
+        with self.lock:
+            self.scheduled = False
+            return {
+                'counters': [ [ name, labels, value ] for (name, labels), value in self.counters.items() ],
+                'histograms': [ [ name, labels, list(values) ] for (name, labels), values in self.histograms.items() ],
+            }
+
+
+    def flush(self):
+        """Writes the values of this process to its file"""
+
+        tmp = self.path.with_suffix('.tmp')
+
+        with self.flush_lock:
+            snapshot = self._snapshot()
+            try:
+                with tmp.open('w') as f:
+                    json.dump(snapshot, f)
+                os.replace(str(tmp), str(self.path))
+            except OSError:
+                pass
+
+        return snapshot
+
+
+    def _read(self, path):
+
+        try:
+            with path.open() as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def _archive(self, dead):
+        """Adds the files of dead processes to the archive and removes them
+
+        Under a flock, so two workers do not archive the same file twice.
+        """
+
+        with (self.directory / 'archive.lock').open('a') as lock:
+
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                counters = Counter()
+                histograms = {}
+
+                archive = self._read(self.archive)
+
+                if archive:
+                    _add(counters, histograms, archive)
+
+                dead = [ path for path in dead if path.exists() ]
+
+                if not dead:
+                    return
+
+                for path in dead:
+                    snapshot = self._read(path)
+                    if snapshot:
+                        _add(counters, histograms, snapshot)
+
+                tmp = self.archive.with_suffix('.tmp')
+
+                with tmp.open('w') as f:
+                    json.dump({
+                        'counters': [ [ name, labels, value ] for (name, labels), value in counters.items() ],
+                        'histograms': [ [ name, labels, values ] for (name, labels), values in histograms.items() ],
+                    }, f)
+
+                os.replace(str(tmp), str(self.archive))
+
+                for path in dead:
+                    path.unlink()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def collect(self):
+        """Returns (counters, histograms) added up across every process, live or archived"""
+
+        counters = Counter()
+        histograms = {}
+
+        snapshots = [ self.flush() ]
+        dead = []
+
+        for path in self.directory.glob('metrics-*.json'):
+
+            pid = int(path.stem.split('-')[1])
+
+            if pid == self.pid:
+                continue
+
+            if not _alive(pid):
+                dead.append(path)
+                continue
+
+            snapshots.append(self._read(path))
+
+        if dead:
+            try:
+                self._archive(dead)
+            except OSError:
+                pass
+
+        snapshots.append(self._read(self.archive))
+
+        for snapshot in snapshots:
+            if snapshot:
+                _add(counters, histograms, snapshot)
+
+        return counters, histograms
+
+
+    def render(self):
+        """All the metrics, in the Prometheus text exposition format"""
+
+        counters, histograms = self.collect()
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, DESCRIPTIONS.get(name, name)))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        def label_text(labels, extra=()):
+            pairs = [ '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels + extra ]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, 'counter')
+            lines.append('{}{} {}'.format(name, label_text(labels), value))
+
+        for (name, labels), values in sorted(histograms.items()):
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip([ repr(float(b)) for b in BUCKETS ] + ['+Inf'], values[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, label_text(labels, (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, label_text(labels), values[-1]))
+            lines.append('{}_count{} {}'.format(name, label_text(labels), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware():
+
+    def __init__(self, metrics):
+        """Falcon middleware timing every request (WSGI and ASGI apps)"""
+
+        self.metrics = metrics
+
+
+    def process_request(self, req, resp):
+
+        req.context.metrics_start = perf_counter()
+
+
+    def process_response(self, req, resp, resource, req_succeeded):
+
+        start = getattr(req.context, 'metrics_start', None)
+
+        if start is None:
+            return
+
+        self.metrics.observe('asydns_http_request_duration_seconds', perf_counter() - start,
+            route=getattr(req, 'uri_template', None) or 'none',
+            method=req.method,
+            status=str(resp.status)[:3],
+        )
+
+
+    async def process_request_async(self, req, resp):
+
+        self.process_request(req, resp)
+
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class InstrumentedClient():
+
+    def __init__(self, client, metrics, service):
+        """Wraps a boto3 client, timing its calls and counting the failed ones
+
+        Paginators and waiters are returned as they are (their calls are not timed).
+        """
+
+        self.client = client
+        self.metrics = metrics
+        self.service = service
+
+
+    def __getattr__(self, name):
+
+        attr = getattr(self.client, name)
+
+        if not callable(attr) or name.startswith('get_paginator') or name.startswith('get_waiter'):
+            return attr
+
+        metrics = self.metrics
+        histogram = 'asydns_{}_call_duration_seconds'.format(self.service)
+        errors = 'asydns_{}_errors_total'.format(self.service)
+
+        def call(*args, **kwargs):
+            try:
+                with metrics.time(histogram, operation=name):
+                    return attr(*args, **kwargs)
+            except Exception as e:
+                code = getattr(e, 'response', {}).get('Error', {}).get('Code') or type(e).__name__
+                metrics.count(errors, operation=name, code=code)
+                raise
+
+        return call
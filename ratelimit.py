@@ -0,0 +1,243 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import pwd
+import struct
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import time
+
+
+MAGIC = b'ASYRTL01'
+
+# header: magic, slots, rate, burst
+HEADER = struct.Struct('<8sQdd')
+HEADER_SIZE = 64
+
+# slot: key hash (0 is empty), tokens, last update
+SLOT = struct.Struct('<Qdd')
+
+# slots probed for a key before replacing the least recently used one
+PROBES = 8
+
+
+def ratelimit_file(config, name):
+    """Path of a shared limiter (in config 'ratelimit_dir', /dev/shm or ~/.asydns)"""
+
+    if config.get('ratelimit_dir'):
+        directory = Path(config['ratelimit_dir'])
+    elif Path('/dev/shm').is_dir():
+        directory = Path('/dev/shm')
+    else:
+        directory = Path(pwd.getpwuid(os.getuid()).pw_dir) / '.asydns'
+
+    return directory / 'asydns-ratelimit-{}-{}'.format(name, os.getuid())
+
+
+def rate_limiter(config, name, rate, burst):
+    """Returns the limiter for config 'ratelimit_mode' (local or shared)"""
+
+    mode = config.get('ratelimit_mode', 'local')
+
+    if mode == 'local':
+        return RateLimiter(config, rate, burst)
+
+    if mode == 'shared':
+        return SharedRateLimiter(config, rate, burst, ratelimit_file(config, name))
+
+    raise Exception('InvalidConfig', 'Invalid ratelimit_mode ({}). Options: local,shared'.format(mode))
+
+
+class RateLimiter():
+
+    def __init__(self, config, rate, burst):
+        """Token buckets per key: rate tokens per second, up to burst
+
+        A request can take several tokens at once (e.g. many challenges): it is
+        allowed if the bucket has one, and the bucket goes negative, so the next ones
+        wait until that is paid back.
+
+        This one keeps the buckets in the process, as an LRU bounded by
+        'ratelimit_entries'. A bucket idle long enough to be full again is the
+        same as no bucket at all, so those are evicted as soon as they are found.
+        """
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        self.max_entries = int(config.get('ratelimit_entries', 100000))
+        self.buckets = OrderedDict()
+
+        self.lock = Lock()
+
+
+    def _take(self, tokens, last, now, n=1):
+        """Returns (tokens left, seconds to wait) after taking n tokens from the bucket"""
+
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        if tokens >= 1:
+            return tokens - n, 0
+
+        return tokens, (1 - tokens) / self.rate
+
+
+    def _full(self, tokens, last, now):
+
+        return tokens + (now - last) * self.rate >= self.burst
+
+
+    def take(self, key, n=1):
+        """Takes n tokens for key. Returns 0 if allowed, or the seconds to wait (Retry-After)"""
+
+        return math.ceil(self.delay(key, n))
+
+
+    def peek(self, key):
+        """Like take, but without taking the token"""
+
+        tokens, last = self._bucket(key)
+        tokens = min(self.burst, tokens + (time() - last) * self.rate)
+
+        return 0 if tokens >= 1 else math.ceil((1 - tokens) / self.rate)
+
+
+    def _bucket(self, key):
+        """Returns (tokens, last update) of the bucket of key"""
+
+        now = time()
+
+        with self.lock:
+            return self.buckets.get(key, (self.burst, now))
+
+
+    def delay(self, key, n=1):
+        """Takes n tokens for key. Returns 0 if allowed, or the exact seconds until there is one"""
+
+        now = time()
+
+        with self.lock:
+
+            while self.buckets:
+                oldest = next(iter(self.buckets))
+                if not self._full(*self.buckets[oldest], now) and len(self.buckets) < self.max_entries:
+                    break
+                del self.buckets[oldest]
+
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens, wait = self._take(tokens, last, now, n)
+            self.buckets[key] = (tokens, now)
+
+        return wait
+
+
+class SharedRateLimiter(RateLimiter):
+
+    def __init__(self, config, rate, burst, path):
+        """Token buckets in a memory-mapped file, shared by every worker
+
+        A fixed table of 'ratelimit_entries' slots. A key uses the one of PROBES
+        slots (from its hash) that has it; if none does, the first empty or idle one,
+        or else the least recently used of them is replaced. Updates are serialized
+        with flock.
+        """
+
+        super().__init__(config, rate, burst)
+
+        self.path = path
+        self.slots = self.max_entries
+
+        size = HEADER_SIZE + self.slots * SLOT.size
+        header = HEADER.pack(MAGIC, self.slots, self.rate, self.burst)
+
+        self.file = os.fdopen(os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+
+        with self._lock():
+            current = self.file.read(HEADER.size)
+            if current != header or os.fstat(self.file.fileno()).st_size != size:
+                self.file.truncate(0)
+                self.file.truncate(size)
+                self.file.seek(0)
+                self.file.write(header)
+                self.file.flush()
+
+        self.mm = mmap.mmap(self.file.fileno(), size)
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reopen)
+
+
+    def _reopen(self):
+        """In a forked worker, opens the file again
+
+        flock locks belong to the open file, so with the one inherited from the parent
+        (e.g. gunicorn --preload) every worker would hold the lock at the same time.
+        """
+
+        self.lock = Lock()
+        self.file = os.fdopen(os.open(str(self.path), os.O_RDWR), 'r+b')
+
+
+    @contextmanager
+    def _lock(self):
+
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+    def _find(self, h, now):
+        """Returns (offset, tokens, last) of the slot for the key hash h"""
+
+        free = None
+        candidates = []
+
+        # the key can be past a slot that went idle or empty after it was placed
+        for i in range(PROBES):
+            offset = HEADER_SIZE + ((h + i) % self.slots) * SLOT.size
+            key, tokens, last = SLOT.unpack_from(self.mm, offset)
+            if key == h:
+                return offset, tokens, last
+            if free is None and (key == 0 or self._full(tokens, last, now)):
+                free = offset
+            candidates.append((last, offset))
+
+        if free is None:
+            last, free = min(candidates)
+
+        return free, self.burst, now
+
+
+    def _hash(self, key):
+
+        return int.from_bytes(hashlib.sha224(key.encode()).digest()[:8], 'little') | 1
+
+
+    def _bucket(self, key):
+
+        now = time()
+
+        with self._lock():
+            offset, tokens, last = self._find(self._hash(key), now)
+
+        return tokens, last
+
+
+    def delay(self, key, n=1):
+
+        now = time()
+        h = self._hash(key)
+
+        with self._lock():
+            offset, tokens, last = self._find(h, now)
+            tokens, wait = self._take(tokens, last, now, n)
+            SLOT.pack_into(self.mm, offset, h, tokens, now)
+
+        return wait
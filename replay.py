@@ -0,0 +1,164 @@
+import fcntl
+import mmap
+import os
+import pwd
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import time
+
+
+MAGIC = b'ASYRPL01'
+
+# header: magic, bits per filter, window, filters
+HEADER = struct.Struct('<8sQQQ')
+HEADER_SIZE = 64
+
+# every filter starts with the epoch (time // window) it holds
+EPOCH = struct.Struct('<q')
+EPOCH_SIZE = 8
+
+FILTERS = 3
+
+
+def replay_file(config):
+    """Path of the shared filters (config 'replay_file', or a per user file in /dev/shm)"""
+
+    if config.get('replay_file'):
+        return Path(config['replay_file'])
+
+    shm = Path('/dev/shm')
+
+    if shm.is_dir():
+        return shm / 'asydns-replay-{}'.format(os.getuid())
+
+    return Path(pwd.getpwuid(os.getuid()).pw_dir) / '.asydns' / 'replay.bin'
+
+
+class ReplayGuard():
+
+    def __init__(self, config):
+        """Remembers the challenges already used, to reject replayed responses
+
+        A ring of Bloom filters in a memory-mapped file, so every gunicorn worker sees
+        the same set. Each filter holds the challenges used during one window
+        ('challenge_window' seconds); a challenge is only valid for one window after
+        it was issued, so the current and the previous filters are enough, and the
+        oldest one is cleared and reused when a new window starts.
+
+        The key is the SHA224 digest of the challenge bytes, and (as it is already a
+        uniform hash) the filter positions are just 4 byte slices of it.
+        """
+
+        self.window = int(config.get('challenge_window', 30))
+        self.bits = int(config.get('replay_bloom_bits', 2 ** 24))
+        self.hashes = min(int(config.get('replay_bloom_hashes', 7)), 7)
+
+        self.path = replay_file(config)
+        self.filter_size = EPOCH_SIZE + (self.bits + 7) // 8
+
+        size = HEADER_SIZE + FILTERS * self.filter_size
+        header = HEADER.pack(MAGIC, self.bits, self.window, FILTERS)
+
+        self.lock = Lock()
+        self.file = os.fdopen(os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+
+        with self._lock():
+            current = self.file.read(HEADER.size)
+            if current != header or os.fstat(self.file.fileno()).st_size != size:
+                self.file.truncate(0)
+                self.file.truncate(size)
+                self.file.seek(0)
+                self.file.write(header)
+                self.file.flush()
+
+        self.mm = mmap.mmap(self.file.fileno(), size)
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reopen)
+
+
+    def _reopen(self):
+        """In a forked worker, opens the file again
+
+        flock locks belong to the open file, so with the one inherited from the parent
+        (e.g. gunicorn --preload) every worker would hold the lock at the same time.
+        """
+
+        self.lock = Lock()
+        self.file = os.fdopen(os.open(str(self.path), os.O_RDWR), 'r+b')
+
+
+    @contextmanager
+    def _lock(self):
+
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+    def _offset(self, epoch):
+
+        return HEADER_SIZE + (epoch % FILTERS) * self.filter_size
+
+
+    def _positions(self, digest):
+
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[i * 4:i * 4 + 4], 'little') % self.bits
+
+
+    def _contains(self, epoch, digest):
+
+        offset = self._offset(epoch)
+
+        if EPOCH.unpack_from(self.mm, offset)[0] != epoch:
+            return False
+
+        offset += EPOCH_SIZE
+
+        for p in self._positions(digest):
+            if not self.mm[offset + p // 8] & (1 << (p % 8)):
+                return False
+
+        return True
+
+
+    def seen(self, digest, now=None):
+        """True if the challenge digest was (probably) used already
+
+        Lock free, meant to reject replays before verifying any signature. A false
+        negative here (a filter being cleared) is caught by add().
+        """
+
+        epoch = int(now or time()) // self.window
+
+        return self._contains(epoch, digest) or self._contains(epoch - 1, digest)
+
+
+    def add(self, digest):
+        """Marks the challenge digest as used. Returns False if it was already used"""
+
+        now = int(time())
+        epoch = now // self.window
+        offset = self._offset(epoch)
+
+        with self._lock():
+
+            if self.seen(digest, now):
+                return False
+
+            if EPOCH.unpack_from(self.mm, offset)[0] != epoch:
+                self.mm[offset + EPOCH_SIZE:offset + self.filter_size] = bytes(self.filter_size - EPOCH_SIZE)
+                EPOCH.pack_into(self.mm, offset, epoch)
+
+            offset += EPOCH_SIZE
+
+            for p in self._positions(digest):
+                self.mm[offset + p // 8] |= 1 << (p % 8)
+
+        return True
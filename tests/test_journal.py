@@ -0,0 +1,175 @@
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from threading import Event
+from time import sleep, time
+
+from journal import Journal
+
+
+class Rejected(Exception):
+
+    response = { 'Error': { 'Code': 'InvalidChangeBatch' } }
+
+
+class RecordingBackend():
+
+    def __init__(self, hold=None, reject=None):
+        """Records the changes applied to it, blocking on the first update of hold until released
+
+        The updates of reject fail, and with them the whole update_many (like a ChangeBatch).
+        """
+
+        self.calls = []
+        self.batches = []
+        self.hold = hold
+        self.reject = reject
+        self.release = Event()
+
+
+    def update(self, registry, ip):
+
+        if registry == self.hold:
+            self.release.wait()
+
+        if registry == self.reject:
+            raise Rejected()
+
+        self.calls.append(('update', registry, ip))
+
+
+    def update_many(self, updates):
+
+        self.batches.append([ registry for registry, ip in updates ])
+
+        if self.reject in self.batches[-1]:
+            raise Rejected()
+
+        for registry, ip in updates:
+            self.update(registry, ip)
+
+
+    def revoke(self, registry):
+
+        self.calls.append(('revoke', registry))
+
+
+def wait_applied(journal, timeout=5):
+
+    deadline = time() + timeout
+
+    while journal.pending and time() < deadline:
+        sleep(0.01)
+
+
+class JournalOrderTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = Path(tempfile.mkdtemp())
+        self.config = { 'journal_fsync_interval': 0 }
+
+
+    def test_update_after_pending_revoke_is_dropped(self):
+
+        backend = RecordingBackend(hold='a')
+        journal = Journal(self.config, backend, self.dir)
+
+        # the apply thread is busy with a, so the changes of b stay pending
+        journal.submit('update', 'a', '1.1.1.1')
+        journal.submit('revoke', 'b')
+
+        self.assertIsNone(journal.submit('update', 'b', '2.2.2.2'))
+        self.assertTrue(journal.is_revoking('b'))
+
+        backend.release.set()
+        wait_applied(journal)
+
+        self.assertEqual(backend.calls, [('update', 'a', '1.1.1.1'), ('revoke', 'b')])
+
+
+    def test_revoke_replaces_pending_update(self):
+
+        backend = RecordingBackend(hold='a')
+        journal = Journal(self.config, backend, self.dir)
+
+        journal.submit('update', 'a', '1.1.1.1')
+        journal.submit('update', 'b', '2.2.2.2')
+        journal.submit('revoke', 'b')
+
+        backend.release.set()
+        wait_applied(journal)
+
+        self.assertEqual(backend.calls, [('update', 'a', '1.1.1.1'), ('revoke', 'b')])
+
+
+    def test_recovered_revoke_is_not_replaced(self):
+
+        entries = [
+            { 'seq': 1, 'op': 'revoke', 'registry': 'b', 'address': None, 'time': int(time()) },
+            { 'seq': 2, 'op': 'update', 'registry': 'b', 'address': '2.2.2.2', 'time': int(time()) },
+        ]
+
+        # journal of a dead process (no lock on it)
+        with (self.dir / '1.log').open('w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+        backend = RecordingBackend()
+        journal = Journal(self.config, backend, self.dir)
+
+        wait_applied(journal)
+
+        self.assertEqual(backend.calls, [('revoke', 'b')])
+
+
+    def test_backlog_is_applied_in_chunks(self):
+
+        backend = RecordingBackend(hold='a')
+        journal = Journal(self.config, backend, self.dir)
+
+        journal.submit('update', 'a', '1.1.1.1')
+        journal.submit_many('update', [ (r, '2.2.2.2') for r in 'bcdef' ])
+
+        backend.release.set()
+        wait_applied(journal)
+
+        self.assertEqual(backend.batches, [['a'], list('bcdef')])
+
+
+    def test_rejected_change_is_dropped(self):
+
+        backend = RecordingBackend(hold='a', reject='c')
+        journal = Journal(self.config, backend, self.dir)
+
+        journal.submit('update', 'a', '1.1.1.1')
+        journal.submit_many('update', [ (r, '2.2.2.2') for r in 'bcd' ])
+
+        backend.release.set()
+        wait_applied(journal)
+
+        self.assertEqual(backend.calls, [('update', 'a', '1.1.1.1'), ('update', 'b', '2.2.2.2'), ('update', 'd', '2.2.2.2')])
+        self.assertFalse(journal.pending)
+
+
+    def test_journal_of_same_pid_is_recovered(self):
+
+        entry = { 'seq': 1, 'op': 'update', 'registry': 'a', 'address': '1.1.1.1', 'time': int(time()) }
+
+        # left by a dead process that had the pid of this one
+        with (self.dir / '{}.log'.format(os.getpid())).open('w') as f:
+            f.write(json.dumps(entry) + '\n')
+
+        backend = RecordingBackend()
+        journal = Journal(self.config, backend, self.dir)
+
+        wait_applied(journal)
+
+        self.assertEqual(backend.calls, [('update', 'a', '1.1.1.1')])
+        self.assertEqual(list(self.dir.glob('*.log')), [journal.path])
+
+
+if __name__ == '__main__':
+    unittest.main()
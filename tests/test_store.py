@@ -0,0 +1,88 @@
+import hashlib
+import tempfile
+import unittest
+from pathlib import Path
+from threading import Thread
+from time import sleep
+
+from backend.store import INITIAL_SLOTS, MAX_LOAD, SEQ, SEQ_OFFSET, RecordStore
+
+
+def registry(i):
+
+    return hashlib.sha224(str(i).encode()).hexdigest()
+
+
+class RecordStoreTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = Path(tempfile.mkdtemp())
+        self.store = RecordStore(self.dir)
+
+
+    def test_set_and_get(self):
+
+        self.store.set(registry(1), '1.2.3.4', 100)
+        self.store.set(registry(2), '2001:db8::1', 200)
+        self.store.set(registry(1), '5.6.7.8', 300)
+
+        self.assertEqual(self.store.get(registry(1)), ('5.6.7.8', 300, False))
+        self.assertEqual(self.store.get(registry(2)), ('2001:db8::1', 200, False))
+        self.assertIsNone(self.store.get(registry(3)))
+        self.assertEqual(self.store.count(), 2)
+
+
+    def test_revoke_is_permanent(self):
+
+        self.store.set(registry(1), '1.2.3.4', 100)
+        self.store.revoke(registry(1), 200)
+        self.store.set(registry(1), '5.6.7.8', 300)
+
+        self.assertEqual(self.store.get(registry(1)), (None, 200, True))
+        self.assertEqual(RecordStore(self.dir).get(registry(1)), (None, 200, True))
+
+
+    def test_read_waits_for_the_writer(self):
+
+        self.store.set(registry(1), '1.2.3.4', 100)
+
+        number = self.store.lookup(bytes.fromhex(registry(1)))
+        offset = self.store._offset(number)
+        seq = self.store.seq(number)
+
+        # a writer in the middle of a change leaves the seq odd
+        SEQ.pack_into(self.store.dat, offset + SEQ_OFFSET, seq + 1)
+
+        result = []
+        reader = Thread(target=lambda: result.append(self.store.read(number)), daemon=True)
+        reader.start()
+
+        sleep(0.05)
+        self.assertTrue(reader.is_alive())
+
+        SEQ.pack_into(self.store.dat, offset + SEQ_OFFSET, seq + 2)
+        reader.join(5)
+
+        self.assertEqual(result, [('1.2.3.4', 100, 0, seq + 2)])
+
+
+    def test_index_grows_in_the_background(self):
+
+        reader = RecordStore(self.dir, writable=False)
+        count = int(INITIAL_SLOTS * MAX_LOAD) * 3
+
+        for i in range(count):
+            self.store.set(registry(i), '10.0.{}.{}'.format(i // 256, i % 256), i)
+
+        self.assertGreater(self.store.slots, INITIAL_SLOTS)
+        self.assertEqual(self.store.count(), count)
+
+        for i in range(count):
+            address = '10.0.{}.{}'.format(i // 256, i % 256)
+            self.assertEqual(self.store.get(registry(i)), (address, i, False))
+            self.assertEqual(reader.get(registry(i)), (address, i, False))
+
+
+if __name__ == '__main__':
+    unittest.main()